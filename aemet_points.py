@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+
+# Builders of the InfluxDB points of the AEMET responses: the radiation CSV (sun_radiation) and the observations of
+# observacion/convencional/todas (aemet_observacion_convencional). They are shared by aemet_radiacion.py and
+# replay.py, so this module must not do anything when it's imported: no local.json, no log handlers.
+
+from influxdb_client import Point, WritePrecision
+import profiler
+import csv
+import logging
+from datetime import datetime, timedelta
+from dateutil import parser
+import pytz
+import numpy as np
+from astral.sun import sun
+from astral import Observer
+
+# The handlers are set up by the script that uses the builders
+logger = logging.getLogger()
+
+def solar_to_epoch(latitude, longitude, altitude, date, solar_time): # Alternative: https://gist.github.com/mnpenner/8b6e7cceb930402d3f37ba9c59fa1d26
+    """
+    Convert solar time to epoch timestamp.
+
+    Args:
+    - latitude (float): Latitude of the location.
+    - longitude (float): Longitude of the location.
+    - altitude (float): Altitude of the location.
+    - date (str): Date in the format 'YYYY-MM-DD'.
+    - solar_time (float): Solar time in hours.
+
+    Returns:
+    - int: Epoch timestamp corresponding to the solar time.
+    """
+
+    # Create an observer using the given latitude, longitude and altitude
+    observer = Observer(latitude, longitude, altitude)
+
+    # Convert date string to date object
+    date_obj = datetime.strptime(date, '%Y-%m-%d').date()
+
+    # Convert solar time to hours and minutes
+    hours, minutes = divmod(int(solar_time * 60), 60)
+
+    # Convert date string to datetime object
+    solar_datetime = datetime.strptime(date, '%Y-%m-%d')
+
+    # Add hours and minutes to datetime object
+    solar_datetime += timedelta(hours=hours, minutes=minutes)
+
+    # Calculate sunrise and sunset times for the specified date
+    s = sun(observer, date=date_obj)
+
+    # Save solar noon
+    solar_noon = s['noon']
+    logger.info("%s %s", solar_datetime, solar_noon)
+
+    # Calculate the time difference between solar noon and UTC
+    offset = solar_datetime - solar_noon
+
+    # Calculate the adjusted solar time
+    adjusted_solar_time = int(solar_time) + int(offset.seconds / 3600)
+    adjusted_solar_minutes = int((solar_time % 1) * 60)
+
+    # Handle cases where adjusted solar time exceeds 24 or is negative
+    if adjusted_solar_time >= 24:
+        adjusted_solar_time -= 24
+    elif adjusted_solar_time < 0:
+        adjusted_solar_time += 24
+
+    # Create a datetime object for the adjusted solar time
+    solar_datetime = date_obj.combine(date_obj, date_obj.time(hour=adjusted_solar_time, minute=adjusted_solar_minutes))
+
+    # Get the epoch timestamp for the solar datetime
+    solar_epoch = int(solar_datetime.timestamp())
+
+    return solar_epoch
+
+def process_entry(entry, timezone_name):
+    """
+    Process a single entry in the JSON data and build its InfluxDB point.
+
+    Args:
+    - entry (dict): A dictionary representing a single entry in the JSON data.
+    - timezone_name (str): The timezone of the station, from StationTimezones.
+
+    Returns:
+    - Point: The point.
+    """
+    # Create a new point for the entry
+    point = Point("aemet_observacion_convencional") \
+        .tag("idema", entry["idema"]) \
+        .tag("ubi", entry["ubi"])
+
+    # print(entry["ubi"],entry)
+
+    for key, value in entry.items():
+        # Check if the key is 'ifema' or 'fint'
+        if key not in ['ifema', 'fint']:
+            # Check if the key is 'geo850'
+            if key == 'geo850':
+                # Add the value to the InfluxDB point
+                point.field(key, value['value'])
+            else:
+                # Add the key-value pair to the InfluxDB point
+                point.field(key, value)
+
+    # convert the string to a datetime object
+    dt = parser.parse(entry["fint"])
+
+    # get the timezone of the station
+    tzname = pytz.timezone(timezone_name)
+
+    # check if daylight saving time is in effect at the given datetime
+    dst_in_effect = tzname.localize(dt, is_dst=None).dst() != timedelta(0)
+
+    # apply the timezone and daylight saving time to the datetime object
+    dt_tz = tzname.localize(dt, is_dst=dst_in_effect)
+
+    # convert the datetime object to epoch time
+    epoch = int(dt_tz.timestamp())
+    point.time(epoch - 60, WritePrecision.S)
+
+    return point
+
+# Characters escaped in the tag values of the line protocol, the same as influxdb_client
+tag_escapes = str.maketrans({ ",": r"\,", "=": r"\=", " ": r"\ ", "\n": r"\n", "\t": r"\t", "\r": r"\r" })
+
+@profiler.timed('point build')
+def radiation_points(rows, stations, saved_stations=None, unknown_stations=None):
+    """
+    Build the sun_radiation points of the AEMET radiation CSV, as its rows come. Every data row (a station and a
+    day) is parsed as a radiation type x solar hour matrix and its points are built together, as line protocol.
+
+    Args:
+    - rows (iterable): The rows of the CSV, as read by csv.DictReader.
+    - stations (dict): The stations of observacion/convencional/todas by idema, from station_index. The stations
+      that aren't there are skipped.
+    - saved_stations (set): If given, the idemas of the stations that are saved are added to it.
+    - unknown_stations (set): If given, the idemas of the stations that aren't in stations are added to it.
+
+    Yields:
+    - str: The line protocol of every station, hour and radiation type, with the time in nanoseconds.
+    """
+    hour_columns = None # Which columns of the header are solar hours
+    hour_index = None # Column of the matrix of every column of the CSV
+    hours = None
+    day_times = None # Time of every solar hour of the current day
+
+    # Define the measurement name
+    measurement_name = "sun_radiation"
+
+    for row in rows:
+        # print(row.keys())
+        if None not in row:
+            date = row['RADIACION SOLAR']
+            day_times = None
+        elif row[None][1] == 'Tipo': # Header
+            header = np.array(row[None][1:])
+            hour_columns = np.char.isdigit(header)
+            hour_index = np.cumsum(hour_columns) - 1
+            hours = header[hour_columns].astype(float)
+            day_times = None
+        else: # Data row
+            # print('estation', row['RADIACION SOLAR'], date, 'identifier', row[None][0])
+            # print(row[None][1:])
+            identifier = row[None][0]
+            estation = row['RADIACION SOLAR']
+            station = stations.get(identifier)
+            if station is None or station['lat'] == 0 or station['lon'] == 0: # In case the station isn't on the observacion/convencional/todas endpoint
+                logger.warning("%s (%s) isn't on the observacion/convencional/todas endpoint. Data will not be saved", estation, identifier)
+                if station is None and unknown_stations is not None:
+                    unknown_stations.add(identifier)
+                continue
+            else:
+                logger.info("Saving data from %s (%s), date: %s", estation, identifier, date)
+                if saved_stations is not None:
+                    saved_stations.add(identifier)
+
+            if day_times is None:
+                # Once per day, the hours are solar time and they're saved as such
+                day = datetime.strptime(date, '%d-%m-%y')
+                day_times = np.array([int((day + timedelta(hours=hour)).timestamp()) for hour in hours], dtype=np.int64) * 10**9
+                # actual_time = solar_to_epoch(station['lat'], station['lon'], station['alt'], day.strftime('%Y-%m-%d'), solar_time)
+
+            cells = np.array(row[None][1:len(hour_columns) + 1])
+            columns = np.arange(len(cells))
+            # Every value belongs to the radiation type written before it in the row
+            is_value = np.char.isdigit(cells)
+            type_columns = np.flatnonzero(~is_value)
+            last_type = np.maximum.accumulate(np.where(is_value, -1, columns))
+            values = is_value & hour_columns[:len(cells)] & (last_type >= 0)
+
+            # Radiation type x solar hour, -1 where there is no value
+            matrix = np.full((len(type_columns), len(hours)), -1, dtype=np.int64)
+            matrix[np.searchsorted(type_columns, last_type[values]), hour_index[:len(cells)][values]] = cells[values].astype(np.int64)
+
+            prefix = f"{measurement_name},estation={estation.translate(tag_escapes)},identifier={identifier.translate(tag_escapes)}"
+            type_tags = [f",radiation_type={radiation_type.translate(tag_escapes)}" if radiation_type else "" for radiation_type in cells[type_columns]]
+            type_rows, hour_cols = np.nonzero(matrix >= 0)
+            yield from [f"{prefix}{type_tags[type_row]} value={value} {time}"
+                        for type_row, value, time in zip(type_rows.tolist(), matrix[type_rows, hour_cols].tolist(), day_times[hour_cols].tolist())]
+
+def csv_rows(filename):
+    """
+    Yields:
+    - dict: The rows of a radiation CSV, as read by csv.DictReader, without loading the whole file.
+    """
+    with open(filename, 'r') as file:
+        yield from csv.DictReader(file, delimiter=';')
+
+def csv_identifiers(filename):
+    """
+    Returns:
+    - set: The idemas of the stations of a radiation CSV, without building its points.
+    """
+    return { row[None][0] for row in csv_rows(filename) if None in row and row[None][1] != 'Tipo' }
@@ -1,22 +1,23 @@
 #!/usr/bin/python3
 
-from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influx_writer import connect_influxdb, BatchWriter
+from archive import ResponseArchive
+from retry import RetryPolicy
+from aemet_stations import StationCache, StationTimezones
+from aemet_points import process_entry, radiation_points, csv_rows, csv_identifiers
+import metrics
+import profiler
 import json
 import requests
 import time
-from datetime import datetime, timedelta
-from dateutil import parser, tz
+from dateutil import tz
 from dateutil.relativedelta import relativedelta
-import pytz
 import csv
 import os
 import argparse 
-from timezonefinder import TimezoneFinder
+import glob
 from multiprocessing import Pool
 import math
-from astral.sun import sun
-from astral import Observer
 import logging
 from logging.handlers import RotatingFileHandler
 
@@ -50,218 +51,140 @@ logger.addHandler(handler)
 aemet_apikey = config['aemet_apikey']
 base_url = "https://opendata.aemet.es/opendata/api/"
 
-# Set up the InfluxDB client
-client = InfluxDBClient(url=config['influxdb']['url'], token=config['influxdb']['token'], org=config['influxdb']['org'])
+# Backoff, circuit breaker and timeouts of the AEMET requests, as set in the "retry" section of local.json
+retry = RetryPolicy(config, base_url)
 
-# Set the bucket name
-bucket_name = config['influxdb']['bucket']
-
-# Get a write API instance for the bucket
-write_api = client.write_api(write_options=SYNCHRONOUS)
-write_api = client.write_api(bucket=bucket_name)
-
-def solar_to_epoch(latitude, longitude, altitude, date, solar_time): # Alternative: https://gist.github.com/mnpenner/8b6e7cceb930402d3f37ba9c59fa1d26
+def csv_files(patterns):
     """
-    Convert solar time to epoch timestamp.
+    Expand the --filename arguments.
 
     Args:
-    - latitude (float): Latitude of the location.
-    - longitude (float): Longitude of the location.
-    - altitude (float): Altitude of the location.
-    - date (str): Date in the format 'YYYY-MM-DD'.
-    - solar_time (float): Solar time in hours.
+    - patterns (list): CSV files, directories (their radiaciondiaria_*.csv files) or glob patterns.
 
     Returns:
-    - int: Epoch timestamp corresponding to the solar time.
+    - list: The CSV files, sorted so they are imported in order.
     """
+    files = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            files.update(glob.glob(os.path.join(pattern, 'radiaciondiaria_*.csv')))
+        else:
+            files.update(glob.glob(pattern))
+    return sorted(files)
 
-    # Create an observer using the given latitude, longitude and altitude
-    observer = Observer(latitude, longitude, altitude)
-
-    # Convert date string to date object
-    date_obj = datetime.strptime(date, '%Y-%m-%d').date()
-
-    # Convert solar time to hours and minutes
-    hours, minutes = divmod(int(solar_time * 60), 60)
-
-    # Convert date string to datetime object
-    solar_datetime = datetime.strptime(date, '%Y-%m-%d')
-
-    # Add hours and minutes to datetime object
-    solar_datetime += timedelta(hours=hours, minutes=minutes)
-
-    # Calculate sunrise and sunset times for the specified date
-    s = sun(observer, date=date_obj)
-
-    # Save solar noon
-    solar_noon = s['noon']
-    logger.info("%s %s", solar_datetime, solar_noon)
-
-    # Calculate the time difference between solar noon and UTC
-    offset = solar_datetime - solar_noon
-
-    # Calculate the adjusted solar time
-    adjusted_solar_time = int(solar_time) + int(offset.seconds / 3600)
-    adjusted_solar_minutes = int((solar_time % 1) * 60)
-
-    # Handle cases where adjusted solar time exceeds 24 or is negative
-    if adjusted_solar_time >= 24:
-        adjusted_solar_time -= 24
-    elif adjusted_solar_time < 0:
-        adjusted_solar_time += 24
-
-    # Create a datetime object for the adjusted solar time
-    solar_datetime = date_obj.combine(date_obj, date_obj.time(hour=adjusted_solar_time, minute=adjusted_solar_minutes))
+def init_worker(worker_stations):
+    global stations, worker_writer
+    stations = worker_stations
+    # Every worker writes the points of its files, so a file is never held in memory whole
+    worker_writer = BatchWriter(connect_influxdb(config), config)
 
-    # Get the epoch timestamp for the solar datetime
-    solar_epoch = int(solar_datetime.timestamp())
+def import_file(filename):
+    """
+    Write the points of a radiation CSV a batch at a time, in a pool worker.
 
-    return solar_epoch
+    Returns:
+    - tuple: The idemas that were saved and the idemas that aren't in the station cache.
+    """
+    saved_stations = set()
+    unknown_stations = set()
+    worker_writer.write_stream(radiation_points(csv_rows(filename), stations, saved_stations, unknown_stations))
+    worker_writer.flush()
+    return saved_stations, unknown_stations
 
-def process_entry(entry):
+def fetch_observations(archive):
     """
-    Process a single entry in the JSON data and write it to InfluxDB.
+    Request the last observations of every station, they also have the coordinates of the stations.
 
     Args:
-    - entry (dict): A dictionary representing a single entry in the JSON data.
+    - archive (ResponseArchive): Where the raw response is saved, so the CSVs can be replayed later.
 
     Returns:
-    - None
+    - list: The entries of observacion/convencional/todas.
     """
-    # Create a new point for the entry
-    point = Point(measurement_name) \
-        .tag("idema", entry["idema"]) \
-        .tag("ubi", entry["ubi"])
-
-    # print(entry["ubi"],entry)
-
-    for key, value in entry.items():
-        # Check if the key is 'ifema' or 'fint'
-        if key not in ['ifema', 'fint']:
-            # Check if the key is 'geo850'
-            if key == 'geo850':
-                # Add the value to the InfluxDB point
-                point.field(key, value['value'])
-            else:
-                # Add the key-value pair to the InfluxDB point
-                point.field(key, value)
-
-    # convert the string to a datetime object
-    dt = parser.parse(entry["fint"])
-
-    # get the timezone at the given latitude and longitude
-    tf = TimezoneFinder()
-    lat, lon = entry["lat"], entry["lon"]
-    tzname = pytz.timezone(tf.timezone_at(lng=lon, lat=lat))
+    r = retry.call(lambda: requests.get(base_url + 'observacion/convencional/todas', params={"api_key": aemet_apikey}, timeout=retry.timeout), 'observacion/convencional/todas')
+    r = retry.call(lambda: requests.get(r.json()['datos'], params={"api_key": aemet_apikey}, timeout=retry.timeout), 'datos')
+    with profiler.phase('JSON decode'):
+        json_data = r.json() # We can get lat/lon from here
+    archive.record('observacion/convencional/todas', {}, json_data)
+    return json_data
 
-    # check if daylight saving time is in effect at the given datetime
-    dst_in_effect = tzname.localize(dt, is_dst=None).dst() != timedelta(0)
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--filename', nargs='+', help='CSV files to import, directories (their radiaciondiaria_*.csv files) or glob patterns')
+    profiler.add_arguments(arg_parser)
+    args = arg_parser.parse_args()
+    profiler.setup(args)
 
-    # apply the timezone and daylight saving time to the datetime object
-    dt_tz = tzname.localize(dt, is_dst=dst_in_effect)
+    # Export the metrics of the run, if "metrics" is set in local.json
+    metrics.setup(config)
 
-    # convert the datetime object to epoch time
-    epoch = int(dt_tz.timestamp())
-    point.time(epoch - 60, WritePrecision.S)
+    # Set up the InfluxDB client
+    client = connect_influxdb(config)
 
-    # Write the point to the bucket
-    write_api.write(bucket=bucket_name, record=point)
+    # Buffer the points and write them to the bucket in batches
+    writer = BatchWriter(client, config)
 
-if __name__ == '__main__':
-    r = requests.get(base_url + 'observacion/convencional/todas', params={"api_key": aemet_apikey})
-    r = requests.get(r.json()['datos'], params={"api_key": aemet_apikey})
-    json_data = r.json() # We can get lat/lon from here
+    # Raw copy of the station list, if "archive" is set in local.json, so the CSVs can be replayed later
+    archive = ResponseArchive(config, 'aemet')
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--filename', help='CSV filename')
-    args = parser.parse_args()
+    # Coordinates of the stations saved by the previous runs
+    station_cache = StationCache(config)
 
+    json_data = None
     if args.filename:
-        with open(args.filename, 'r') as file:
-            csv_reader = csv.DictReader(file, delimiter=';')
-            data = []
-            for row in csv_reader:
-                data.append(row)
+        # Old CSVs only need the coordinates of their stations. The files are parsed in parallel and every worker
+        # writes the points of its files as they are built, a batch at a time
+        files = csv_files(args.filename)
+
+        # The station list is only requested if some station of the files isn't in the cache and the cache is
+        # stale. The stations are looked up before the files are parsed, so every file is parsed once, in the pool
+        identifiers = set()
+        for filename in files:
+            identifiers |= csv_identifiers(filename)
+        if not identifiers <= set(station_cache.stations) and station_cache.stale():
+            json_data = fetch_observations(archive)
+            station_cache.update(json_data)
+
+        saved_stations = set()
+        missing = set()
+        with Pool(initializer=init_worker, initargs=(station_cache.stations,)) as pool:
+            for saved, unknown in pool.imap(import_file, files):
+                saved_stations |= saved
+                missing |= unknown
+        print("Imported", len(files), "files")
+        if missing:
+            print(len(missing), "stations aren't in the station list, their data was not saved:", ", ".join(sorted(missing)))
+            if json_data is None:
+                print("The station list is requested again once it's older than station_ttl")
     else:
+        # The observations are always requested for the daily CSV
+        json_data = fetch_observations(archive)
+        station_cache.update(json_data)
+
         # Define the measurement name
-        r = requests.get(base_url + 'red/especial/radiacion/', params={"api_key": aemet_apikey})
-        r.raise_for_status()
+        r = retry.call(lambda: requests.get(base_url + 'red/especial/radiacion/', params={"api_key": aemet_apikey}, timeout=retry.timeout), 'red/especial/radiacion')
         # print(r.json())
 
-        r_data = requests.get(r.json()['datos'], stream=True) # https://stackoverflow.com/a/39064678
-        r_data.raise_for_status()
+        # The read timeout also applies to every chunk of the download, so a stalled transfer ends the run
+        r_data = retry.call(lambda: requests.get(r.json()['datos'], stream=True, timeout=retry.timeout), 'datos') # https://stackoverflow.com/a/39064678
 
-        csv_reader = csv.DictReader(r_data.iter_lines(decode_unicode=True), delimiter=';')
-        data = []
-        for row in csv_reader:
-            data.append(row)
+        # The rows are parsed as the lines arrive and the points are written a batch at a time, while the rest of
+        # the CSV is still downloading
+        csv_reader = csv.DictReader(profiler.timed_iter('fetch', r_data.iter_lines(decode_unicode=True)), delimiter=';')
 
-    row_tipo = [] # To save the header so we can access the hours
+        # Build the points of the radiation CSV and write them to the bucket
+        saved_stations = set()
+        writer.write_stream(radiation_points(csv_reader, station_cache.stations, saved_stations))
 
+    if json_data is not None:
+        stations = station_cache.stations
+        # Timezone of every station, TimezoneFinder is only used for the stations seen for the first time
+        timezones = StationTimezones(config)
+        for data in json_data:
+            if data['idema'] in saved_stations: # We save only relevant data
+                writer.write(process_entry(data, timezones.timezone(stations[data['idema']])))
+        timezones.save()
 
-    # Define the measurement name
-    measurement_name = "sun_radiation"
-
-    identifier_array = []
-
-    for row in data:
-        # print(row.keys())
-        if None not in row:
-            date = row['RADIACION SOLAR']
-        else:
-            if row[None][1] == 'Tipo': # Header
-                row_tipo = row[None]
-            else: # Data row
-                # print('estation', row['RADIACION SOLAR'], date, 'identifier', row[None][0])
-                # print(row[None][1:])
-                identifier = row[None][0]
-                estation = row['RADIACION SOLAR']
-                latitude = 0.0
-                longitude = 0.0
-                for data in json_data:
-                    if data['idema'] == identifier:
-                        # print(data)
-                        latitude = data['lat']
-                        longitude = data['lon']
-                        altitude = data['alt']
-                        break
-                if latitude == 0 or longitude == 0: # In case the station isn't on the observacion/convencional/todas endpoint
-                    logger.warning("%s (%s) isn't on the observacion/convencional/todas endpoint. Data will not be saved", estation, identifier)
-                    continue
-                else:
-                    logger.info("Saving data from %s (%s), date: %s", estation, identifier, date)
-                    identifier_array.append(identifier)
-                for i, value in enumerate(row[None][1:]):
-                    if not value.isdigit():
-                        radiation_type = value
-                    elif row_tipo[i+1].isdigit():
-                        solar_time = float(row_tipo[i+1])
-                        value_date = datetime.strptime(date, '%d-%m-%y') + timedelta(hours=solar_time)
-                        value_date_epoch = int(value_date.timestamp())
-                        # actual_time = solar_to_epoch(latitude, longitude, altitude, datetime.strptime(date, '%d-%m-%y').strftime('%Y-%m-%d'), solar_time)
-                        # logger.info("%s %s", solar_datetime, solar_noon)
-                        # logger.info("Saving data estation: %s identifier: %s radiation_type: %s value_date: %s value: %s", estation, identifier, radiation_type, value_date, value)
-                        # Create a new point for the entry
-                        point = Point(measurement_name) \
-                            .tag("estation", estation) \
-                            .tag("identifier", identifier) \
-                            .tag("radiation_type", radiation_type) \
-                            .field("value", float(value)) \
-                            .time(int(value_date_epoch), WritePrecision.S)
-                        # Write the point to the bucket
-                        write_api.write(bucket=bucket_name, record=point)
-
-    # Define the measurement name
-    measurement_name = "aemet_observacion_convencional"
-    # Create a multiprocessing pool
-    pool = Pool()
-    for data in json_data:
-        if data['idema'] in identifier_array: # We save only relevant data
-            pool.apply_async(process_entry, args=(data,))
-    # Close the pool and wait for all processes to complete
-    pool.close()
-    pool.join()
-
-    # Close the write API connection
-    write_api.__del__()
+    # Write the remaining points and close the write API connection
+    writer.close()
     exit()
\ No newline at end of file
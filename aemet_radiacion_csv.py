@@ -12,6 +12,7 @@ from dateutil.relativedelta import relativedelta
 import pytz
 import csv
 import os
+from retry import RetryPolicy
 
 # Load the configuration from local.json
 with open('local.json', 'r') as json_file:
@@ -20,6 +21,9 @@ with open('local.json', 'r') as json_file:
 aemet_apikey = config['aemet_apikey']
 url = "https://opendata.aemet.es/opendata/api/red/especial/radiacion/"
 
+# Backoff, circuit breaker and timeouts of the AEMET requests, as set in the "retry" section of local.json
+retry = RetryPolicy(config, url)
+
 # Set up the InfluxDB client
 client = InfluxDBClient(url=config['influxdb']['url'], token=config['influxdb']['token'], org=config['influxdb']['org'])
 
@@ -27,11 +31,9 @@ client = InfluxDBClient(url=config['influxdb']['url'], token=config['influxdb'][
 bucket_name = config['influxdb']['bucket']
 
 # Define the measurement name
-r = requests.get(url, params={"api_key": aemet_apikey})
-r.raise_for_status()
+r = retry.call(lambda: requests.get(url, params={"api_key": aemet_apikey}, timeout=retry.timeout), 'red/especial/radiacion')
 
-r_data = requests.get(r.json()['datos'], stream=True) # https://stackoverflow.com/a/39064678
-r_data.raise_for_status()
+r_data = retry.call(lambda: requests.get(r.json()['datos'], stream=True, timeout=retry.timeout), 'datos') # https://stackoverflow.com/a/39064678
 
 csv_reader = csv.DictReader(r_data.iter_lines(decode_unicode=True))
 data = []
@@ -54,7 +56,7 @@ if r_data.status_code == 200:
     os.makedirs(folder, exist_ok=True)
 
     with open(filename, 'wb') as f:
-        r_data = requests.get(r.json()['datos'], stream=True) # https://stackoverflow.com/a/39064678
+        r_data = retry.call(lambda: requests.get(r.json()['datos'], stream=True, timeout=retry.timeout), 'datos') # https://stackoverflow.com/a/39064678
         for chunk in r_data.iter_content(chunk_size=1024):
             f.write(chunk)
     exit()
\ No newline at end of file
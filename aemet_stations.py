@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+
+# Metadata of the AEMET stations, used by aemet_radiacion.py. station_index() indexes the station list of
+# observacion/convencional/todas by idema, so every row of the radiation CSV finds its station in constant time.
+#
+# The coordinates of the stations are also saved on disk (StationCache), so importing a CSV of stations we already
+# know doesn't need the two requests of observacion/convencional/todas. The cache is refreshed once it's older than
+# the TTL.
+#
+# Finding the timezone of a station with TimezoneFinder loads its polygon data, which takes far longer than
+# everything else, so the timezone of every station is saved the first time it's seen and reused by the next runs.
+# It's only looked up again if the station moves.
+#
+# Optional settings in the "aemet" section of local.json:
+#   "station_file": ".aemet_stations.json"
+#   "station_ttl": 86400        Seconds before the station list is requested again
+#   "timezone_file": ".aemet_timezones.json"
+
+import json
+import os
+import time
+from timezonefinder import TimezoneFinder
+
+default_station_file = '.aemet_stations.json'
+default_station_ttl = 24 * 3600
+default_timezone_file = '.aemet_timezones.json'
+
+# Station metadata kept in the cache, the rest of the entry are observations
+station_fields = ["idema", "ubi", "lat", "lon", "alt"]
+
+
+def station_index(json_data):
+    """
+    Index the stations of observacion/convencional/todas by idema.
+
+    Args:
+    - json_data (list): The entries of observacion/convencional/todas, there are several per station (one per hour).
+
+    Returns:
+    - dict: The last entry of every station, with its lat, lon and alt, by idema.
+    """
+    return { entry['idema']: entry for entry in json_data }
+
+
+class StationCache:
+    """
+    Coordinates and altitude of every station, by idema, saved between runs.
+
+    Args:
+    - config (dict): The configuration loaded from local.json.
+    """
+
+    def __init__(self, config):
+        settings = config.get('aemet', {})
+        self.station_file = settings.get('station_file', default_station_file)
+        self.ttl = settings.get('station_ttl', default_station_ttl)
+        try:
+            with open(self.station_file, 'r') as json_file:
+                cache = json.load(json_file)
+            self.updated = cache['updated']
+            self.stations = cache['stations']
+        except (OSError, ValueError, KeyError):
+            self.updated = 0
+            self.stations = {}
+
+    def stale(self):
+        """
+        Returns:
+        - bool: True if the stations are older than the TTL.
+        """
+        return time.time() - self.updated >= self.ttl
+
+    def update(self, json_data):
+        """
+        Save the stations of a fresh observacion/convencional/todas response. The stations that aren't in it are
+        kept, old CSVs may still have them.
+
+        Args:
+        - json_data (list): The entries of observacion/convencional/todas.
+        """
+        for idema, entry in station_index(json_data).items():
+            self.stations[idema] = { field: entry.get(field) for field in station_fields }
+        self.updated = time.time()
+        tmp_file = self.station_file + '.tmp'
+        with open(tmp_file, 'w') as json_file:
+            json.dump({ "updated": self.updated, "stations": self.stations }, json_file)
+        os.replace(tmp_file, self.station_file)
+
+
+class StationTimezones:
+    """
+    Timezone of every station, by idema.
+
+    Args:
+    - config (dict): The configuration loaded from local.json.
+    """
+
+    def __init__(self, config):
+        self.timezone_file = config.get('aemet', {}).get('timezone_file', default_timezone_file)
+        try:
+            with open(self.timezone_file, 'r') as json_file:
+                self.stations = json.load(json_file)
+        except (OSError, ValueError):
+            self.stations = {}
+        # Only created if there is a station we haven't seen
+        self.finder = None
+        self.changed = False
+
+    def timezone(self, station):
+        """
+        Args:
+        - station (dict): An entry of observacion/convencional/todas, with its idema, lat and lon.
+
+        Returns:
+        - str: The name of the timezone of the station, like 'Europe/Madrid'.
+        """
+        cached = self.stations.get(station['idema'])
+        if cached is not None and cached['lat'] == station['lat'] and cached['lon'] == station['lon']:
+            return cached['timezone']
+
+        if self.finder is None:
+            self.finder = TimezoneFinder()
+        timezone_name = self.finder.timezone_at(lng=station['lon'], lat=station['lat'])
+        self.stations[station['idema']] = { "lat": station['lat'], "lon": station['lon'], "timezone": timezone_name }
+        self.changed = True
+        return timezone_name
+
+    def save(self):
+        """
+        Save the timezones of the new stations for the next runs.
+        """
+        if not self.changed:
+            return
+        tmp_file = self.timezone_file + '.tmp'
+        with open(tmp_file, 'w') as json_file:
+            json.dump(self.stations, json_file)
+        os.replace(tmp_file, self.timezone_file)
+        self.changed = False
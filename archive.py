@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+
+# Optional archive of the raw responses of the FusionSolar, REE and i-DE APIs, so the data can be processed
+# again later without calling the (rate limited) APIs. Every response is appended to a compressed segment file
+# as its own zstd frame (or gzip member if zstandard isn't installed), and a line with its endpoint, params,
+# fetch time, offset and length is appended to the index file next to the segment. Each run writes its own
+# segments, so several scripts can archive at the same time, and segments are never modified once closed.
+#
+# Optional setting in local.json, the archive is disabled without it:
+#   "archive": { "dir": "archive", "compression": "zstd", "segment_size": 67108864 }
+
+import atexit
+from datetime import datetime, timezone
+import glob
+import gzip
+import json
+import os
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+default_archive_dir = 'archive'
+default_segment_size = 64 * 1024 * 1024
+
+extensions = { "zstd": ".zst", "gzip": ".gz" }
+
+
+def compress(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return gzip.compress(data)
+
+
+def decompress(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+class ResponseArchive:
+    """
+    Append-only archive of raw API responses.
+
+    Args:
+    - config (dict): The configuration loaded from local.json.
+    - source (str): Name of the API, like 'fusionsolar', 'ree' or 'ide'. Every source has its own directory.
+    """
+
+    def __init__(self, config, source):
+        settings = config.get('archive')
+        self.enabled = settings is not None
+        if not self.enabled:
+            return
+        self.directory = os.path.join(settings.get('dir', default_archive_dir), source)
+        self.compression = settings.get('compression', 'zstd')
+        if self.compression == 'zstd' and zstandard is None:
+            print("zstandard isn't installed, archiving with gzip")
+            self.compression = 'gzip'
+        self.segment_size = settings.get('segment_size', default_segment_size)
+        self.segment = None
+        self.index = None
+        self.segment_number = 0
+        # The backfill engine archives from several threads
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        atexit.register(self.close)
+
+    def open_segment(self):
+        self.segment_number += 1
+        name = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S') + '-' + str(os.getpid()) + '-' + str(self.segment_number)
+        path = os.path.join(self.directory, name + extensions[self.compression])
+        self.segment = open(path, 'ab')
+        self.index = open(path + '.idx', 'a')
+
+    def record(self, endpoint, params, response):
+        """
+        Append a response to the archive. Does nothing if the archive isn't enabled.
+
+        Args:
+        - endpoint (str): The API call, like 'getDevHistoryKpi' or 'indicators/1001'.
+        - params (dict): The payload or the query parameters of the request.
+        - response: The decoded JSON response.
+        """
+        if not self.enabled:
+            return
+        fetched = int(time.time() * 1000)
+        entry = { "endpoint": endpoint, "params": params, "fetched": fetched, "response": response }
+        data = compress(json.dumps(entry, ensure_ascii=False).encode('utf-8'), self.compression)
+
+        with self.lock:
+            if self.segment is None or self.segment.tell() >= self.segment_size:
+                self.close_segment()
+                self.open_segment()
+            offset = self.segment.tell()
+            self.segment.write(data)
+            self.segment.flush()
+            self.index.write(json.dumps({ "endpoint": endpoint, "params": params, "fetched": fetched, "offset": offset, "length": len(data) }) + '\n')
+            self.index.flush()
+
+    def close_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.index.close()
+            self.segment = None
+            self.index = None
+
+    def close(self):
+        """
+        Close the current segment, the next record will start a new one.
+        """
+        if self.enabled:
+            with self.lock:
+                self.close_segment()
+
+
+def list_segments(directory, source=None):
+    """
+    Find the archived segments.
+
+    Args:
+    - directory (str): The archive directory.
+    - source (str): Only the segments of this source, like 'fusionsolar'. All of them if None.
+
+    Returns:
+    - list: The paths of the segments, oldest first.
+    """
+    segments = []
+    for extension in extensions.values():
+        segments += glob.glob(os.path.join(directory, source or '*', '*' + extension))
+    return sorted(segments, key=os.path.basename)
+
+
+def read_segment(path, endpoints=None, start=None, end=None):
+    """
+    Read the records of a segment, using its index to skip the ones that don't match the filters.
+
+    Args:
+    - path (str): The segment file.
+    - endpoints (list): Only the records of these endpoints. All of them if None.
+    - start (int): Only the records fetched from this epoch time in milliseconds.
+    - end (int): Only the records fetched before this epoch time in milliseconds.
+
+    Returns:
+    - generator: dicts with the endpoint, params, fetched and response of every record.
+    """
+    compression = 'zstd' if path.endswith(extensions['zstd']) else 'gzip'
+    with open(path + '.idx', 'r') as index, open(path, 'rb') as segment:
+        for line in index:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line of a segment that was being written when the script died
+                continue
+            if endpoints is not None and entry['endpoint'] not in endpoints:
+                continue
+            if (start is not None and entry['fetched'] < start) or (end is not None and entry['fetched'] >= end):
+                continue
+            segment.seek(entry['offset'])
+            yield json.loads(decompress(segment.read(entry['length']), compression))
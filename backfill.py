@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+# Backfill engine for the historical windows of the FusionSolar interfaces. Windows are fetched concurrently
+# (every request still waits on the shared rate limiter), but their results are handled strictly in order, so
+# the points are written and the watermarks saved in the same order as a sequential run would do. Every script
+# that backfills from its start date (getDevHistoryKpi, getDevKpi*, getKpiStation* and the historical
+# getStationRealKpi) builds its windows per station or device and runs them here.
+#
+# Optional setting in the "fusionsolar" section of local.json, or --max-in-flight:
+#   "max_in_flight": 4      Maximum number of windows being fetched at the same time
+
+import asyncio
+from collections import deque
+
+default_max_in_flight = 4
+
+
+def split_windows(start_time, end_time, step):
+    """
+    Split a time range in consecutive windows.
+
+    Args:
+    - start_time (datetime): Start of the first window.
+    - end_time (datetime): The windows cover up to this time.
+    - step (timedelta or relativedelta): The length of every window.
+
+    Returns:
+    - list: The start time of every window.
+    """
+    windows = []
+    while start_time < end_time:
+        windows.append(start_time)
+        start_time += step
+    return windows
+
+
+def add_arguments(arg_parser):
+    """
+    Add --max-in-flight to the arguments of a script.
+
+    Args:
+    - arg_parser (ArgumentParser): The parser of the script.
+    """
+    arg_parser.add_argument('--max-in-flight', type=int, help='Maximum number of windows requested at the same time')
+
+
+def max_in_flight(args, config):
+    """
+    Returns:
+    - int: The --max-in-flight of the run, or the max_in_flight of local.json.
+    """
+    return args.max_in_flight or config['fusionsolar'].get('max_in_flight', default_max_in_flight)
+
+
+async def run_windows(windows, fetch, handle, max_in_flight):
+    # At most max_in_flight windows are fetched or waiting to be handled at the same time
+    pending = deque()
+    for window in windows:
+        pending.append((window, asyncio.create_task(asyncio.to_thread(fetch, window))))
+        if len(pending) >= max_in_flight:
+            window, task = pending.popleft()
+            handle(window, await task)
+    while pending:
+        window, task = pending.popleft()
+        handle(window, await task)
+
+
+def run_backfill(windows, fetch, handle, max_in_flight=default_max_in_flight):
+    """
+    Fetch the windows concurrently and handle their results in order.
+
+    Args:
+    - windows (list): The windows to fetch, in the order their results must be handled. Every window can be
+      anything fetch() understands, e.g. a (devIds, start time) tuple.
+    - fetch (callable): fetch(window) requests the window to the API and returns its response. It runs in a
+      worker thread.
+    - handle (callable): handle(window, data) builds and writes the points and saves the watermark. It runs in
+      the main thread, one window after the other.
+    - max_in_flight (int): Maximum number of windows fetched at the same time.
+    """
+    asyncio.run(run_windows(windows, fetch, handle, max_in_flight))
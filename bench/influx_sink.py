@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+
+# Local stand-in for the InfluxDB v2 API, for the benchmarks. It accepts the line protocol writes (gzipped or not)
+# and only counts them: points, bytes and the days they cover. Queries get an empty answer, so the scripts
+# without a watermark start from their default time.
+#
+# Example:
+#   python3 bench/influx_sink.py --port 8099
+# and in local.json:
+#   "influxdb": { "url": "http://127.0.0.1:8099", "token": "bench", "org": "bench", "bucket": "bench" }
+
+import argparse
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Units per day of every write precision
+precision_day = { "s": 86400, "ms": 86400 * 10**3, "us": 86400 * 10**6, "ns": 86400 * 10**9 }
+
+
+class InfluxSink:
+    """
+    Counters of the writes received.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the counters, between two benchmarks.
+        """
+        with self.lock:
+            self.points = 0
+            self.bytes = 0
+            self.writes = 0
+            self.days = set()
+
+    def stats(self):
+        with self.lock:
+            return { "points": self.points, "bytes": self.bytes, "writes": self.writes, "days": len(self.days) }
+
+    def write(self, body, precision):
+        """
+        Count the points of a write request.
+
+        Args:
+        - body (bytes): The line protocol, already decompressed.
+        - precision (str): The precision of the timestamps.
+        """
+        days = set()
+        points = 0
+        for line in body.split(b'\n'):
+            if not line or line.startswith(b'#'):
+                continue
+            points += 1
+            timestamp = line.rsplit(b' ', 1)[-1]
+            if timestamp.isdigit():
+                days.add(int(timestamp) // precision_day[precision])
+        with self.lock:
+            self.points += points
+            self.bytes += len(body)
+            self.writes += 1
+            self.days |= days
+
+
+def serve(sink, port, host='127.0.0.1'):
+    """
+    Start the HTTP server of the sink in a background thread.
+
+    Returns:
+    - ThreadingHTTPServer: The server, call shutdown() to stop it.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            url = urlparse(self.path)
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if url.path == '/api/v2/write':
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                sink.write(body, parse_qs(url.query).get('precision', ['ns'])[0])
+                self.send_response(204)
+                self.end_headers()
+            elif url.path == '/api/v2/query':
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/csv; charset=utf-8')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                self.send_error(404)
+
+        def do_GET(self):
+            if self.path != '/stats':
+                self.send_error(404)
+                return
+            response = json.dumps(sink.stats()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--port', type=int, default=8099)
+    args = arg_parser.parse_args()
+
+    serve(InfluxSink(), args.port)
+    print(f"InfluxDB sink listening on http://127.0.0.1:{args.port}, stats on /stats")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+
+# Local stand-in for the FusionSolar northbound API (thirdData), for the benchmarks. It answers login,
+# getStationList, getDevList, getKpiStationHour/Day/Month/Year, getStationRealKpi, getDevRealKpi, getDevHistoryKpi
+# and getDevKpiDay/Month/Year with synthetic data, and it behaves like the real one when it's abused: over the rate
+# limit it answers failCode 407, and it can expire the session every N calls so the clients get failCode 305.
+#
+# Example:
+#   python3 bench/mock_fusionsolar.py --stations 50 --rate 20 --relogin-every 500
+# and in local.json:
+#   "fusionsolar": { "base_url": "http://127.0.0.1:8098/thirdData/", ... }
+
+import argparse
+import calendar
+import json
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from points import station_kpi_fields, station_real_kpi_fields
+
+# Device types of every station, in this order
+dev_types = [1, 47, 10, 17, 38, 39, 41]
+
+# Fields of the device KPIs, the rest of the types get the generic ones
+dev_kpi_fields = {
+    1: ["active_power", "day_cap", "total_cap", "efficiency", "temperature", "mppt_power"],
+    47: ["active_power", "reactive_power", "power_factor", "grid_frequency"],
+}
+generic_dev_kpi_fields = ["active_power", "run_state"]
+
+history_interval = 5 * 60 * 1000
+
+
+class MockFusionSolar:
+    """
+    State of the mock: the synthetic stations and devices, the session and the rate limit of every endpoint.
+
+    Args:
+    - stations (int): Number of stations in the account.
+    - devices (int): Devices per station, their types are taken in order from dev_types.
+    - history_days (int): Days of data before now, the responses are empty before that.
+    - extra_fields (int): Extra fields added to every dataItemMap, to make the payloads bigger.
+    - rate (float): Calls per second accepted by every endpoint before answering 407, no limit if 0.
+    - relogin_every (int): Expire the session after this many calls so the clients get 305, never if 0.
+    """
+
+    def __init__(self, stations=10, devices=3, history_days=30, extra_fields=0, rate=0, relogin_every=0):
+        self.stations = ["NE=%08d" % (33000000 + i) for i in range(stations)]
+        self.devices = {}
+        for i, stationCode in enumerate(self.stations):
+            for k in range(devices):
+                devId = 1000000000000 + i * 100 + k
+                self.devices[devId] = { "id": devId, "devName": f"Device-{i}-{k}", "devTypeId": dev_types[k % len(dev_types)],
+                                        "stationCode": stationCode, "esnCode": f"SN{devId}", "invType": None, "softwareVersion": "V100" }
+        self.history_start = int((time.time() - history_days * 86400) * 1000)
+        self.extra_fields = [f"extra_{i}" for i in range(extra_fields)]
+        self.rate = rate
+        self.relogin_every = relogin_every
+        self.lock = threading.Lock()
+        self.token = None
+        self.buckets = {}
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the counters, between two benchmarks.
+        """
+        with self.lock:
+            self.calls = {}
+            self.fail_codes = { 305: 0, 407: 0 }
+            self.session_calls = 0
+
+    def stats(self):
+        with self.lock:
+            return { "calls": dict(self.calls), "total_calls": sum(self.calls.values()), "fail_codes": dict(self.fail_codes) }
+
+    def allowed(self, endpoint):
+        """
+        Token bucket of an endpoint, one second of burst.
+        """
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(endpoint, (self.rate, now))
+        tokens = min(self.rate, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[endpoint] = (tokens, now)
+            return False
+        self.buckets[endpoint] = (tokens - 1, now)
+        return True
+
+    def handle(self, endpoint, token, payload):
+        """
+        Answer a request.
+
+        Args:
+        - endpoint (str): Interface name, like 'getDevHistoryKpi'.
+        - token (str): The XSRF-TOKEN header of the request.
+        - payload (dict): The decoded JSON body.
+
+        Returns:
+        - dict: The response, and the new XSRF-TOKEN cookie if it's a login.
+        """
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            if endpoint == 'login':
+                self.token = secrets.token_hex(16)
+                self.session_calls = 0
+                return { "data": None, "success": True, "failCode": 0, "params": {}, "message": None }, self.token
+            if token is None or token != self.token:
+                self.fail_codes[305] += 1
+                return { "data": "USER_MUST_RELOGIN", "success": False, "failCode": 305, "params": {}, "message": None }, None
+            self.session_calls += 1
+            if self.relogin_every and self.session_calls >= self.relogin_every:
+                # Someone else logged in with the same user
+                self.token = None
+            if not self.allowed(endpoint):
+                self.fail_codes[407] += 1
+                return { "data": "ACCESS_FREQUENCY_IS_TOO_HIGH", "success": False, "failCode": 407, "params": {}, "message": None }, None
+
+        handler = getattr(self, endpoint, None)
+        if handler is None:
+            return { "data": None, "success": False, "failCode": 20001, "params": payload, "message": "Unknown interface" }, None
+        return { "data": handler(payload), "success": True, "failCode": 0, "params": dict(payload, currentTime=int(time.time() * 1000)), "message": None }, None
+
+    def item_map(self, fields):
+        items = { field: round(random.uniform(0, 1000), 3) for field in fields }
+        for field in self.extra_fields:
+            items[field] = round(random.uniform(0, 1000), 3)
+        return items
+
+    def requested_stations(self, payload):
+        return [stationCode for stationCode in str(payload.get('stationCodes', '')).split(',') if stationCode in self.stations]
+
+    def requested_devices(self, payload):
+        devIds = [int(devId) for devId in str(payload.get('devIds', '')).split(',') if devId]
+        return [self.devices[devId] for devId in devIds if devId in self.devices]
+
+    def collect_times(self, endpoint, collectTime):
+        """
+        Returns:
+        - list: The collectTimes in the period of the response, up to now and from the start of the history.
+        """
+        day = datetime.fromtimestamp(collectTime / 1000, tz=timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        # One more than the entries of the period, it's the end of the last one
+        if endpoint == 'getKpiStationHour':
+            times = [day + timedelta(hours=hour) for hour in range(25)]
+        elif endpoint in ('getKpiStationDay', 'getDevKpiDay'):
+            first = day.replace(day=1)
+            times = [first + timedelta(days=i) for i in range(calendar.monthrange(first.year, first.month)[1] + 1)]
+        elif endpoint in ('getKpiStationMonth', 'getDevKpiMonth'):
+            times = [day.replace(month=month, day=1) for month in range(1, 13)] + [day.replace(year=day.year + 1, month=1, day=1)]
+        else:
+            times = [day.replace(year=year, month=1, day=1) for year in range(day.year - 4, day.year + 2)]
+        now = time.time() * 1000
+        times = [int(t.timestamp() * 1000) for t in times]
+        # Every period with some history in it
+        return [start for start, end in zip(times, times[1:]) if end > self.history_start and start <= now]
+
+    def getStationList(self, payload):
+        return [{ "stationCode": stationCode, "stationName": f"Station {stationCode}", "capacity": 100.0,
+                  "stationAddr": "Salamanca", "aidType": 0 } for stationCode in self.stations]
+
+    def getDevList(self, payload):
+        stationCodes = set(self.requested_stations(payload))
+        return [dict(devList) for devList in self.devices.values() if devList['stationCode'] in stationCodes]
+
+    def station_kpi(self, endpoint, payload):
+        return [{ "stationCode": stationCode, "collectTime": collectTime, "dataItemMap": self.item_map(station_kpi_fields[endpoint]) }
+                for stationCode in self.requested_stations(payload)
+                for collectTime in self.collect_times(endpoint, payload['collectTime'])]
+
+    def getKpiStationHour(self, payload):
+        return self.station_kpi('getKpiStationHour', payload)
+
+    def getKpiStationDay(self, payload):
+        return self.station_kpi('getKpiStationDay', payload)
+
+    def getKpiStationMonth(self, payload):
+        return self.station_kpi('getKpiStationMonth', payload)
+
+    def getKpiStationYear(self, payload):
+        return self.station_kpi('getKpiStationYear', payload)
+
+    def getStationRealKpi(self, payload):
+        return [{ "stationCode": stationCode, "dataItemMap": self.item_map(station_real_kpi_fields) }
+                for stationCode in self.requested_stations(payload)]
+
+    def dev_entry(self, devList, collectTime=None):
+        entry = { "devId": devList['id'], "sn": devList['esnCode'],
+                  "dataItemMap": self.item_map(dev_kpi_fields.get(devList['devTypeId'], generic_dev_kpi_fields)) }
+        if collectTime is not None:
+            entry['collectTime'] = collectTime
+        return entry
+
+    def getDevRealKpi(self, payload):
+        return [self.dev_entry(devList) for devList in self.requested_devices(payload)]
+
+    def getDevHistoryKpi(self, payload):
+        start = max(payload['startTime'], self.history_start)
+        end = min(payload['endTime'], int(time.time() * 1000))
+        start += -start % history_interval
+        return [self.dev_entry(devList, collectTime)
+                for devList in self.requested_devices(payload)
+                for collectTime in range(start, end, history_interval)]
+
+    def dev_kpi(self, endpoint, payload):
+        return [self.dev_entry(devList, collectTime)
+                for devList in self.requested_devices(payload)
+                for collectTime in self.collect_times(endpoint, payload['collectTime'])]
+
+    def getDevKpiDay(self, payload):
+        return self.dev_kpi('getDevKpiDay', payload)
+
+    def getDevKpiMonth(self, payload):
+        return self.dev_kpi('getDevKpiMonth', payload)
+
+    def getDevKpiYear(self, payload):
+        return self.dev_kpi('getDevKpiYear', payload)
+
+
+def serve(mock, port, host='127.0.0.1'):
+    """
+    Start the HTTP server of the mock in a background thread.
+
+    Returns:
+    - ThreadingHTTPServer: The server, call shutdown() to stop it.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if not self.path.startswith('/thirdData/'):
+                self.send_error(404)
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            payload = json.loads(body) if body else {}
+            response, token = mock.handle(self.path[len('/thirdData/'):], self.headers.get('XSRF-TOKEN'), payload or {})
+            response = json.dumps(response).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(response)))
+            if token is not None:
+                self.send_header('Set-Cookie', f'XSRF-TOKEN={token}; Path=/')
+            self.end_headers()
+            self.wfile.write(response)
+
+        def do_GET(self):
+            if self.path != '/stats':
+                self.send_error(404)
+                return
+            response = json.dumps(mock.stats()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_arguments(arg_parser):
+    arg_parser.add_argument('--stations', type=int, default=10, help='Number of stations in the account')
+    arg_parser.add_argument('--devices', type=int, default=3, help='Devices per station')
+    arg_parser.add_argument('--history-days', type=int, default=30, help='Days of data before now')
+    arg_parser.add_argument('--extra-fields', type=int, default=0, help='Extra fields in every dataItemMap, to make the payloads bigger')
+    arg_parser.add_argument('--rate', type=float, default=0, help='Calls per second accepted by every endpoint before answering 407, no limit if 0')
+    arg_parser.add_argument('--relogin-every', type=int, default=0, help='Expire the session after this many calls, never if 0')
+
+
+def from_arguments(args):
+    return MockFusionSolar(args.stations, args.devices, args.history_days, args.extra_fields, args.rate, args.relogin_every)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--port', type=int, default=8098)
+    add_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    serve(from_arguments(args), args.port)
+    print(f"Mock FusionSolar listening on http://127.0.0.1:{args.port}/thirdData/, stats on /stats")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
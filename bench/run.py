@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+
+# Benchmark of the FusionSolar ingesters against local stand-ins, so a change can be measured without touching
+# the production quotas. It starts the mock FusionSolar API and the InfluxDB sink, runs every ingester from a
+# clean working directory (no session, inventory, watermarks or rate limit state) and reports:
+#   points/s        Points received by the sink per second of run
+#   calls/day       FusionSolar calls (login and retries included) per day of data ingested
+#   peak RSS        Maximum resident memory of the ingester
+#
+# Example:
+#   python3 bench/run.py --stations 50 --devices 4 --history-days 30 --rate 50 --relogin-every 1000
+#   python3 bench/run.py --ingester getDevHistoryKpi --extra-fields 20 --output before.json
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import influx_sink
+import mock_fusionsolar
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Script and arguments of every ingester, {start} is replaced by the first day of the mock history
+ingesters = {
+    "getKpiStationHour": ["getKpiStationHour_to_influxdb.py"],
+    "getKpiStationDay": ["getKpiStationDay_to_influxdb.py"],
+    "getKpiStationMonth": ["getKpiStationMonth_to_influxdb.py"],
+    "getKpiStationYear": ["getKpiStationYear_to_influxdb.py"],
+    "getStationRealKpi": ["getKpiStationRealTime_to_influxdb.py"],
+    "getDevHistoryKpi": ["getDevHistoryKpi.py", "--start", "{start}"],
+    "getDevKpiDay": ["getDevKpiDay.py"],
+    "getDevKpiMonth": ["getDevKpiMonth.py"],
+    "getDevKpiYear": ["getDevKpiYear.py"],
+    "getDevRealKpi": ["getDevRealKpi_to_influxdb.py"],
+}
+
+
+def bench_config(mock_url, sink_url):
+    """
+    Returns:
+    - dict: The local.json of the ingesters, pointed at the stand-ins. The rate limiter starts fast, the 407s of
+      the mock slow it down like the real API does.
+    """
+    return {
+        "fusionsolar": { "base_url": mock_url, "userName": "bench", "systemCode": "bench",
+                         "rate_limit": { "initial": 60000, "max": 60000, "increase": 600, "burst": 10 } },
+        "influxdb": { "url": sink_url, "token": "bench", "org": "bench", "bucket": "bench" },
+    }
+
+
+def run_ingester(name, argv, config, mock, sink, keep=False):
+    """
+    Run an ingester from a clean working directory and measure it.
+
+    Args:
+    - name (str): One of the ingesters.
+    - argv (list): The script and its arguments.
+    - config (dict): The local.json to run it with.
+    - mock (MockFusionSolar): The mock API, its counters are reset.
+    - sink (InfluxSink): The sink, its counters are reset.
+    - keep (bool): Keep the working directory, with the output of the run in <name>.log.
+
+    Returns:
+    - dict: The results of the run.
+    """
+    work_dir = tempfile.mkdtemp(prefix='bench-' + name + '-')
+    with open(os.path.join(work_dir, 'local.json'), 'w') as json_file:
+        json.dump(config, json_file)
+    log_path = os.path.join(work_dir, name + '.log')
+
+    mock.reset()
+    sink.reset()
+    start = time.perf_counter()
+    with open(log_path, 'w') as log_file:
+        process = subprocess.Popen([sys.executable, os.path.join(repo_dir, argv[0])] + argv[1:], cwd=work_dir,
+                                   stdout=log_file, stderr=subprocess.STDOUT)
+        # wait4 gives the resource usage of this child alone
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.perf_counter() - start
+
+    api = mock.stats()
+    written = sink.stats()
+    result = {
+        "ingester": name,
+        "exit_code": process.returncode,
+        "wall": wall,
+        "points": written['points'],
+        "bytes": written['bytes'],
+        "days": written['days'],
+        "calls": api['total_calls'],
+        "fail_codes": api['fail_codes'],
+        "points_per_second": written['points'] / wall if wall else 0,
+        "calls_per_day": api['total_calls'] / written['days'] if written['days'] else None,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+    }
+    if process.returncode != 0:
+        print(f"{name} failed with exit code {process.returncode}, see {log_path}")
+        keep = True
+    if keep:
+        result['work_dir'] = work_dir
+    else:
+        shutil.rmtree(work_dir)
+    return result
+
+
+def print_report(results):
+    print(f"{'Ingester':<20}{'Wall (s)':>10}{'Points':>10}{'Points/s':>12}{'Calls':>8}{'Days':>6}{'Calls/day':>11}{'407':>6}{'305':>6}{'MB sent':>9}{'Peak RSS':>10}")
+    for result in results:
+        calls_per_day = f"{result['calls_per_day']:.2f}" if result['calls_per_day'] is not None else '-'
+        print(f"{result['ingester']:<20}{result['wall']:>10.2f}{result['points']:>10}{result['points_per_second']:>12.0f}"
+              f"{result['calls']:>8}{result['days']:>6}{calls_per_day:>11}{result['fail_codes'][407]:>6}{result['fail_codes'][305]:>6}"
+              f"{result['bytes'] / 2**20:>9.2f}{result['peak_rss_mb']:>8.0f}MB")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    mock_fusionsolar.add_arguments(arg_parser)
+    arg_parser.add_argument('--ingester', action='append', choices=list(ingesters), help='Only run this ingester, can be repeated')
+    arg_parser.add_argument('--output', help='Also save the results in this JSON file')
+    arg_parser.add_argument('--keep', action='store_true', help='Keep the working directories, with the output of every run')
+    args = arg_parser.parse_args()
+
+    mock = mock_fusionsolar.from_arguments(args)
+    sink = influx_sink.InfluxSink()
+    mock_server = mock_fusionsolar.serve(mock, 0)
+    sink_server = influx_sink.serve(sink, 0)
+    config = bench_config(f"http://127.0.0.1:{mock_server.server_address[1]}/thirdData/",
+                          f"http://127.0.0.1:{sink_server.server_address[1]}")
+    history_start = (datetime.now(timezone.utc) - timedelta(days=args.history_days)).strftime('%Y-%m-%d')
+
+    results = []
+    for name in args.ingester or ingesters:
+        argv = [arg.format(start=history_start) for arg in ingesters[name]]
+        print("Running", name)
+        results.append(run_ingester(name, argv, config, mock, sink, args.keep))
+
+    mock_server.shutdown()
+    sink_server.shutdown()
+
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as json_file:
+            json.dump(results, json_file, indent=1)
+        print("Results saved in", args.output)
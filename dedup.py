@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+
+# Change detection for the realtime points (getStationRealKpi and getDevRealKpi). Most of their fields don't
+# change between two polls (at night nothing does), so only the fields whose value changed since the last point
+# of the same series are written. Every series is written in full again after the heartbeat interval, so a
+# query over a recent window always finds every field. In daemon mode the last values live in memory, from cron
+# they're saved in a JSON file once the points are written. Every cron script has its own file (the collector name
+# goes before the extension, e.g. .dedup_state.getStationRealKpi.json), cron starts them at the same time and with
+# a shared one each script would put back the state of the other one from the previous run.
+#
+# Optional setting in local.json, every field is written without it:
+#   "dedup": { "heartbeat": 3600, "state_file": ".dedup_state.json" }
+
+from influxdb_client import Point
+import json
+import os
+
+default_heartbeat = 3600
+default_state_file = '.dedup_state.json'
+
+
+class ChangeFilter:
+    """
+    Drop the fields of the realtime points that didn't change.
+
+    Args:
+    - config (dict): The configuration loaded from local.json.
+    - collector (str): Keep the last values in the state file of this collector between runs, for the cron
+      scripts, like 'getStationRealKpi'.
+    """
+
+    def __init__(self, config, collector=None):
+        settings = config.get('dedup')
+        self.enabled = settings is not None
+        if not self.enabled:
+            return
+        self.heartbeat = settings.get('heartbeat', default_heartbeat) * 1000
+        self.state_file = None
+        if collector:
+            base, extension = os.path.splitext(settings.get('state_file', default_state_file))
+            self.state_file = f"{base}.{collector}{extension}"
+        self.series = {}
+        if self.state_file:
+            try:
+                with open(self.state_file, 'r') as json_file:
+                    self.series = json.load(json_file)
+            except (OSError, ValueError):
+                pass
+
+    def filter(self, points, point_time):
+        """
+        Keep only the changed fields of every point, and the points with at least one of them.
+
+        Args:
+        - points (list): The Points of a poll.
+        - point_time (int): Time of the points in milliseconds.
+
+        Returns:
+        - list: The Points to write.
+        """
+        if not self.enabled:
+            return points
+
+        changed_points = []
+        for point in points:
+            key = point._name + ',' + ','.join(f'{key}={point._tags[key]}' for key in sorted(point._tags))
+            fields = { key: value for key, value in point._fields.items() if value is not None }
+            last = self.series.get(key)
+
+            if last is None or point_time - last['written'] >= self.heartbeat:
+                # Heartbeat, write the whole point
+                changed = fields
+                last = { "written": point_time, "fields": {} }
+                self.series[key] = last
+            else:
+                changed = { key: value for key, value in fields.items() if last['fields'].get(key) != value }
+            last['fields'].update(changed)
+
+            if changed:
+                changed_points.append(Point.from_dict({ "measurement": point._name, "tags": point._tags, "fields": changed, "time": point._time },
+                                                      write_precision=point._write_precision))
+        return changed_points
+
+    def save(self):
+        """
+        Save the last values in the state file. Call it once the points are written, e.g. with BatchWriter.on_flush.
+        """
+        if not self.enabled or not self.state_file:
+            return
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as json_file:
+            json.dump(self.series, json_file)
+        os.replace(tmp_file, self.state_file)
@@ -2,6 +2,7 @@
 
 from influxdb_client import InfluxDBClient, Point, WritePrecision
 import json
+from watermarks import WatermarkStore
 
 # Load the configuration from local.json
 with open('local.json', 'r') as json_file:
@@ -21,4 +22,8 @@ predicate = 'indicator = 1295'
 delete_api = client.delete_api()
 
 # Delete all records in the bucket
-delete_api.delete(predicate=predicate, start='1970-01-01T00:00:00Z', stop='2220-01-01T00:00:00Z', bucket=bucket_name)
\ No newline at end of file
+delete_api.delete(predicate=predicate, start='1970-01-01T00:00:00Z', stop='2220-01-01T00:00:00Z', bucket=bucket_name)
+
+# Forget the watermarks of the deleted series, or the scripts would never fetch them again
+watermarks = WatermarkStore(config, client)
+print("Watermarks cleared:", watermarks.clear_predicate(predicate))
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+
+# Cache of the devices of every station (the getDevList responses), shared by the getDev* scripts and
+# getAlarmList.py. Devices barely change, so the list of each station is only requested again once it's older
+# than the TTL, and the stations that need it are requested together, up to max_station_codes at once.
+#
+# Optional settings in the "fusionsolar" section of local.json:
+#   "inventory_file": ".fusionsolar_devices.json"
+#   "inventory_ttl": 86400      Seconds before the devices of a station are requested again
+
+import json
+import os
+import time
+from fusionsolar import max_station_codes, batches
+
+default_inventory_file = '.fusionsolar_devices.json'
+default_inventory_ttl = 24 * 3600
+
+
+class DeviceInventory:
+    """
+    Devices of every station, indexed by stationCode, devTypeId and devId.
+
+    Args:
+    - fs (FusionSolarClient): A logged in client, used to refresh the inventory.
+    - config (dict): The configuration loaded from local.json.
+    """
+
+    def __init__(self, fs, config):
+        self.fs = fs
+        self.inventory_file = config['fusionsolar'].get('inventory_file', default_inventory_file)
+        self.ttl = config['fusionsolar'].get('inventory_ttl', default_inventory_ttl)
+        try:
+            with open(self.inventory_file, 'r') as json_file:
+                self.stations = json.load(json_file)
+        except (OSError, ValueError):
+            self.stations = {}
+        self.index()
+
+    def index(self):
+        self.by_station = { stationCode: station['devices'] for stationCode, station in self.stations.items() }
+        self.by_dev_type = {}
+        self.by_id = {}
+        for devices in self.by_station.values():
+            for devList in devices:
+                self.by_dev_type.setdefault(devList['devTypeId'], []).append(devList)
+                self.by_id[devList['id']] = devList
+
+    def refresh(self, stationCodes):
+        """
+        Request the devices of the stations that aren't in the inventory or whose devices are older than the TTL,
+        and forget the stations that aren't in the account anymore.
+
+        Args:
+        - stationCodes (list): Every stationCode of the account.
+        """
+        now = time.time()
+        expired = [stationCode for stationCode in stationCodes
+                   if stationCode not in self.stations or now - self.stations[stationCode]['updated'] >= self.ttl]
+        changed = set(self.stations) - set(stationCodes)
+        for stationCode in changed:
+            del self.stations[stationCode]
+
+        for stationCodeBatch in batches(expired, max_station_codes):
+            response = self.fs.post('getDevList', { "stationCodes": ",".join(stationCodeBatch) })
+            # print('getDevList\n' + json.dumps(response, indent=1) + '\n\n')
+            if response.get("data") is None:
+                # Keep the devices we already had for these stations
+                print(response)
+                continue
+            for stationCode in stationCodeBatch:
+                self.stations[stationCode] = { "updated": now, "devices": [] }
+            for devList in response['data']:
+                if devList['stationCode'] in self.stations:
+                    self.stations[devList['stationCode']]['devices'].append(devList)
+            changed.update(stationCodeBatch)
+
+        if changed:
+            print("Devices of", len(changed), "stations updated")
+            self.index()
+            self.save()
+
+    def save(self):
+        tmp_file = self.inventory_file + '.tmp'
+        with open(tmp_file, 'w') as json_file:
+            json.dump(self.stations, json_file)
+        os.replace(tmp_file, self.inventory_file)
+
+    def devices(self, dev_types=None):
+        """
+        Args:
+        - dev_types (list): Only the devices of these devTypeIds. All of them if None.
+
+        Returns:
+        - list: Device entries as returned by getDevList.
+        """
+        if dev_types is None:
+            return [devList for devices in self.by_station.values() for devList in devices]
+        return [devList for devTypeId in dev_types for devList in self.by_dev_type.get(devTypeId, [])]
+
+    def station_devices(self, stationCode):
+        """
+        Returns:
+        - list: The devices of a station.
+        """
+        return self.by_station.get(stationCode, [])
+
+    def device(self, devId):
+        """
+        Returns:
+        - dict: The getDevList entry of a device, None if it isn't in the inventory.
+        """
+        return self.by_id.get(devId)
@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+
+# Shared client for the FusionSolar northbound API (thirdData), used by the getKpiStation* and getDev* scripts.
+# It takes care of the login, the XSRF token, the retries, the relogin on failCode 305 and it decodes every
+# response only once.
+
+import datetime
+from dateutil.relativedelta import relativedelta
+import json
+import os
+import threading
+import requests
+from rate_limiter import RateLimiter
+from archive import ResponseArchive
+from retry import RetryPolicy
+import metrics
+import profiler
+
+base_url = 'https://eu5.fusionsolar.huawei.com/thirdData/'
+
+# The following device types are supported by getDevRealKpi and getDevHistoryKpi
+supported_dev_types = [1, 10, 17, 38, 39, 41, 47]
+
+# Maximum number of stationCodes accepted in a single request by getKpiStationHour/Day/Month/Year
+max_station_codes = 100
+
+# Maximum number of devIds, all of the same devTypeId, accepted in a single request
+max_dev_ids = { "getDevRealKpi": 100, "getDevHistoryKpi": 10 }
+
+# Period covered by every response of the interfaces queried with a collectTime, e.g. getDevKpiDay returns the
+# daily values of the whole month collectTime is in
+kpi_periods = {
+    "getKpiStationHour": relativedelta(days=1),
+    "getKpiStationDay": relativedelta(months=1),
+    "getKpiStationMonth": relativedelta(years=1),
+    "getKpiStationYear": relativedelta(years=1),
+    "getDevKpiDay": relativedelta(months=1),
+    "getDevKpiMonth": relativedelta(years=1),
+    "getDevKpiYear": relativedelta(years=1),
+}
+
+# The realtime interfaces are refreshed every 5 minutes
+realtime_interval = 5 * 60
+
+# The session cookies are shared between runs (and between scripts) so cron runs don't have to log in every time
+default_session_file = '.fusionsolar_session.json'
+
+
+class FusionSolarClient:
+    """
+    Session against the FusionSolar northbound API.
+
+    Args:
+    - config (dict): The configuration loaded from local.json.
+    - retry_delay (int): Seconds to wait before the first retry of a failed request, it doubles on every retry.
+      retry.base_delay in local.json takes precedence.
+    """
+
+    def __init__(self, config, retry_delay=30):
+        self.base_url = config['fusionsolar'].get('base_url', base_url)
+        self.login_credentials = { "userName": config["fusionsolar"]["userName"], "systemCode": config["fusionsolar"]["systemCode"]}
+        self.session_file = config['fusionsolar'].get('session_file', default_session_file)
+        # Backoff and circuit breaker for the non-200 answers and the connection errors
+        self.retry = RetryPolicy(config, self.base_url, retry_delay)
+        # Shared with every other script calling the API at the same time
+        self.limiter = RateLimiter(config)
+        # Raw copy of every response, if "archive" is set in local.json
+        self.archive = ResponseArchive(config, 'fusionsolar')
+        self.s = requests.session()
+        # The backfill engine calls post() from several threads
+        self.login_lock = threading.Lock()
+
+    def login(self):
+        """
+        Reuse the session saved by a previous run if there is one, otherwise log in.
+        """
+        if not self.load_session():
+            self.relogin()
+
+    @profiler.timed('login')
+    def relogin(self):
+        """
+        Log in and save the new session cookies so other runs can reuse them.
+        Re-logging will kick previous login, if you are relogging too much it's probably
+        someone or something else using the API too, like a crontab
+        """
+        response = self.retry.call(lambda: self.s.post(self.base_url + 'login', json=self.login_credentials, timeout=self.retry.timeout), 'login')
+
+        # {'data': None, 'success': True, 'failCode': 0, 'params': {}, 'message': None}
+        data = response.json()
+        if data['success'] != True:
+            print('Error at login. Credentials error?')
+            if data['message'] != None:
+                print(data['message'])
+            else:
+                print(data)
+            exit()
+        print("Login successful")
+        self.s.headers['XSRF-TOKEN'] = self.s.cookies.get('XSRF-TOKEN')
+        self.save_session()
+
+    def load_session(self):
+        """
+        Load the session cookies saved by the last login.
+
+        Returns:
+        - bool: True if a session was loaded and it's different from the one we already had.
+        """
+        try:
+            with open(self.session_file, 'r') as json_file:
+                cookies = json.load(json_file)
+        except (OSError, ValueError):
+            return False
+        if not cookies.get('XSRF-TOKEN') or cookies.get('XSRF-TOKEN') == self.s.headers.get('XSRF-TOKEN'):
+            return False
+        self.s.cookies = requests.utils.cookiejar_from_dict(cookies)
+        self.s.headers['XSRF-TOKEN'] = cookies['XSRF-TOKEN']
+        return True
+
+    def save_session(self):
+        tmp_file = self.session_file + '.tmp'
+        with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as json_file:
+            json.dump(requests.utils.dict_from_cookiejar(self.s.cookies), json_file)
+        os.replace(tmp_file, self.session_file)
+
+    def post(self, endpoint, payload=None):
+        """
+        Post a request to the API, retrying until we get a valid answer. Raises UpstreamError (or CircuitOpenError)
+        if FusionSolar doesn't answer.
+
+        Args:
+        - endpoint (str): Interface name, like 'getStationList' or 'getDevHistoryKpi'.
+        - payload (dict): JSON body of the request.
+
+        Returns:
+        - dict: The decoded JSON response.
+        """
+        url = self.base_url + endpoint
+        while True:
+            self.limiter.acquire(endpoint)
+            token = self.s.headers.get('XSRF-TOKEN')
+            response = self.retry.call(lambda: self.s.post(url, json=payload, timeout=self.retry.timeout), endpoint)
+            with profiler.phase('JSON decode'):
+                data = response.json()
+            if data.get('failCode') in (407, 305):
+                metrics.inc('tfg_fusionsolar_fail_codes_total', endpoint=endpoint, failCode=data['failCode'])
+            if data.get('failCode') == 407:
+                print(f"Received 407 status code, we are being rate limited. Url: {url}")
+                self.limiter.throttled(endpoint)
+            elif data.get('failCode') == 305:
+                print('User must re-login')
+                with self.login_lock:
+                    # Another thread or script may have logged in already, try its session before kicking it
+                    if self.s.headers.get('XSRF-TOKEN') == token and not self.load_session():
+                        self.relogin()
+            else:
+                self.limiter.success(endpoint)
+                self.archive.record(endpoint, payload, data)
+                return data
+
+    @profiler.timed('station list')
+    def get_station_codes(self):
+        """
+        Returns:
+        - list: The stationCode of every station in the account.
+        """
+        data = self.post('getStationList')
+        # print('getStationList\n' + json.dumps(data, indent=1) + '\n\n')
+        return [station['stationCode'] for station in data['data']]
+
+
+def batches(items, size):
+    """
+    Split a list in batches so several stationCodes or devIds can be sent in a single request.
+
+    Args:
+    - items (list): The stationCodes or devIds.
+    - size (int): The maximum number of items the interface accepts.
+
+    Returns:
+    - list: Lists of at most size items.
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def group_by_dev_type(devices):
+    """
+    Group devices by devTypeId, as only devices of the same type can be requested together.
+
+    Args:
+    - devices (list): Device entries as returned by getDevList.
+
+    Returns:
+    - dict: The devices of every devTypeId.
+    """
+    groups = {}
+    for device in devices:
+        groups.setdefault(device['devTypeId'], []).append(device)
+    return groups
+
+
+def period_start(measurement_name, query_time):
+    """
+    Get the start of the period query_time is in, e.g. the first day of the month for getDevKpiDay.
+
+    Args:
+    - measurement_name (str): One of the interfaces in kpi_periods.
+    - query_time (datetime): A time inside the period.
+
+    Returns:
+    - datetime: The start of the period, in UTC.
+    """
+    period = kpi_periods[measurement_name]
+    query_time = query_time.astimezone(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if period.months or period.years:
+        query_time = query_time.replace(day=1)
+    if period.years:
+        query_time = query_time.replace(month=1)
+    return query_time
+
+
+def next_period(measurement_name, query_time):
+    """
+    Returns:
+    - datetime: The start of the period that follows the one query_time is in.
+    """
+    return period_start(measurement_name, query_time) + kpi_periods[measurement_name]
+
+
+def collect_time(query_time):
+    """
+    Get the collectTime to request the period that starts at query_time. It's noon UTC of the first day of the
+    period, so it falls inside the same period whatever the timezone of the plant is.
+
+    Returns:
+    - int: The collectTime in milliseconds.
+    """
+    return int((query_time + datetime.timedelta(hours=12)).timestamp() * 1000)
+
+
+def align_time(time_ms, interval=realtime_interval):
+    """
+    Round a time down to the interval, e.g. 10:07:31 to 10:05:00 for 5 minutes.
+
+    Args:
+    - time_ms (int): Epoch time in milliseconds.
+    - interval (int): The interval in seconds.
+
+    Returns:
+    - int: The aligned time in milliseconds.
+    """
+    return time_ms - (time_ms % (interval * 1000))
@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+
+# Gap scanner. The scripts resume from the last point saved, so a hole left behind (a 407 storm, a relogin loop,
+# a crash) is never filled. This counts the points of every series per day with a single grouped query per
+# measurement, compares it with the expected cadence and writes the missing days as a work list, which
+# getDevHistoryKpi.py and getKpiStationHour_to_influxdb.py fetch with --gaps.
+#
+# Example:
+#   python3 gaps.py --start 2023-01-01 --output gaps.json
+#   python3 getDevHistoryKpi.py --gaps gaps.json
+
+import argparse
+import json
+from datetime import datetime, timedelta, timezone
+from influx_writer import connect_influxdb
+
+# Points expected per day for every series, and the tags that identify a series
+expected_cadence = {
+    "getDevHistoryKpi": { "per_day": 288, "tags": ["stationCode", "devId"] },
+    "getKpiStationHour": { "per_day": 24, "tags": ["stationCode"] },
+}
+
+
+def find_gaps(client, bucket_name, measurement_name, start_time, end_time, ratio=1.0):
+    """
+    Find the days with fewer points than expected.
+
+    Args:
+    - client (InfluxDBClient): The InfluxDB client.
+    - bucket_name (str): The bucket to scan.
+    - measurement_name (str): One of the measurements in expected_cadence.
+    - start_time (datetime): Start of the scan, at 00:00 UTC.
+    - end_time (datetime): End of the scan, at 00:00 UTC.
+    - ratio (float): A day is a gap if it has fewer than ratio * the expected points.
+
+    Returns:
+    - list: dicts with the measurement, the tags of the series and the start and end of every gap. Consecutive
+      missing days of a series are merged in a single gap.
+    """
+    cadence = expected_cadence[measurement_name]
+    tags = cadence['tags']
+    columns = json.dumps(tags)
+    # Every field is counted on its own (devices of different types have different fields), the series count is
+    # the count of its most complete field
+    query = (f'from(bucket:"{bucket_name}")'
+             f' |> range(start: {start_time.strftime("%Y-%m-%dT%H:%M:%SZ")}, stop: {end_time.strftime("%Y-%m-%dT%H:%M:%SZ")})'
+             f' |> filter(fn: (r) => r["_measurement"] == "{measurement_name}")'
+             f' |> group(columns: {json.dumps(tags + ["_field"])})'
+             f' |> aggregateWindow(every: 1d, fn: count, createEmpty: true, timeSrc: "_start")'
+             f' |> group(columns: {json.dumps(tags + ["_time"])})'
+             f' |> max()'
+             f' |> group(columns: {columns})')
+    result = client.query_api().query(query)
+
+    gaps = []
+    for table in result:
+        gap = None
+        for record in sorted(table.records, key=lambda record: record.get_time()):
+            day = record.get_time()
+            if (record.get_value() or 0) >= cadence['per_day'] * ratio:
+                gap = None
+                continue
+            if gap is not None and gap['end'] == day:
+                gap['end'] = day + timedelta(days=1)
+                continue
+            gap = { "measurement": measurement_name, "start": day, "end": day + timedelta(days=1) }
+            for tag in tags:
+                gap[tag] = record.values.get(tag)
+            gaps.append(gap)
+    return gaps
+
+
+def load_gaps(filename, measurement_name):
+    """
+    Read the work list written by gaps.py.
+
+    Args:
+    - filename (str): The JSON file.
+    - measurement_name (str): Only the gaps of this measurement.
+
+    Returns:
+    - list: The gaps, with their start and end as UTC datetimes.
+    """
+    with open(filename, 'r') as json_file:
+        gaps = json.load(json_file)
+    gaps = [gap for gap in gaps if gap['measurement'] == measurement_name]
+    for gap in gaps:
+        gap['start'] = datetime.fromisoformat(gap['start'])
+        gap['end'] = datetime.fromisoformat(gap['end'])
+    return gaps
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--start', required=True, help='Start of the scan (YYYY-MM-DD)')
+    arg_parser.add_argument('--end', help='End of the scan (YYYY-MM-DD), today by default so only whole days are scanned')
+    arg_parser.add_argument('--measurement', action='append', choices=list(expected_cadence), help='Only scan this measurement, can be repeated')
+    arg_parser.add_argument('--ratio', type=float, default=1.0, help='A day is a gap if it has fewer than this ratio of the expected points')
+    arg_parser.add_argument('--output', default='gaps.json', help='Where to write the work list')
+    args = arg_parser.parse_args()
+
+    # Load the configuration from local.json
+    with open('local.json', 'r') as json_file:
+        config = json.load(json_file)
+
+    # Set up the InfluxDB client
+    client = connect_influxdb(config)
+
+    start_time = datetime.strptime(args.start, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    if args.end:
+        end_time = datetime.strptime(args.end, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    else:
+        end_time = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    gaps = []
+    for measurement_name in args.measurement or expected_cadence:
+        measurement_gaps = find_gaps(client, config['influxdb']['bucket'], measurement_name, start_time, end_time, args.ratio)
+        print("Found", len(measurement_gaps), "gaps in", measurement_name, "covering", sum((gap['end'] - gap['start']).days for gap in measurement_gaps), "days")
+        gaps += measurement_gaps
+
+    with open(args.output, 'w') as json_file:
+        json.dump(gaps, json_file, indent=1, default=lambda time: time.isoformat())
+    print("Work list saved in", args.output)
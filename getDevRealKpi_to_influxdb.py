@@ -1,149 +1,94 @@
 #!/usr/bin/python3
 
-from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client import Point, WritePrecision
+from points import dev_kpi_points
+from influx_writer import connect_influxdb, BatchWriter
+import metrics
+import argparse
+import profiler
 import json
-import requests
 import time
 import datetime 
 from dateutil import parser
 from dateutil.relativedelta import relativedelta
 import pytz
+from device_inventory import DeviceInventory
+from dedup import ChangeFilter
+from fusionsolar import FusionSolarClient, supported_dev_types, max_dev_ids, batches, group_by_dev_type, align_time
 
-# Load the configuration from local.json
-with open('local.json', 'r') as json_file:
-    config = json.load(json_file)
+# Define the measurement name
+measurement_name = "getDevRealKpi"
 
-# Set up the InfluxDB client
-client = InfluxDBClient(url=config['influxdb']['url'], token=config['influxdb']['token'], org=config['influxdb']['org'])
 
-# Set the bucket name
-bucket_name = influxdb_org = config['influxdb']['bucket']
+def poll_dev_real_kpi(fs, writer, devices, point_time=None, dedup=None):
+    """
+    Request the realtime KPIs of the devices and write them.
+
+    Args:
+    - fs (FusionSolarClient): A logged in client.
+    - writer (BatchWriter): Where the points are written.
+    - devices (list): Device entries as returned by getDevList.
+    - point_time (int): Time in milliseconds to stamp the points with. Defaults to the current time rounded down
+      to 5 minutes, so the series are evenly spaced.
+    - dedup (ChangeFilter): If given, only the fields that changed are written.
+    """
+    if point_time is None:
+        point_time = align_time(int(time.time() * 1000))
+
+    # Devices of the same devTypeId are requested together, up to max_dev_ids at once
+    for devTypeId, devTypeDevices in group_by_dev_type(devices).items():
+        for devBatch in batches(devTypeDevices, max_dev_ids[measurement_name]):
+            data = fs.post(measurement_name, { "devTypeId": devTypeId, "devIds": ",".join(str(devList['id']) for devList in devBatch) })
+            # print(measurement_name + '\n' + json.dumps(data, indent=1) + '\n\n')
+
+            if data.get("data") is None:
+                print(data)
+            else:
+                # print(data)
+                # Every entry of the response is attributed back to its device by devId
+                devStationCodes = { devList['id']: devList['stationCode'] for devList in devBatch }
+                print("Saving " + str(len(data["data"])) + " entries")
+                # Build a point for each entry in the JSON data and write them to the bucket
+                points = dev_kpi_points(measurement_name, data, devStationCodes, point_time, devTypeId)
+                if dedup is not None:
+                    points = dedup.filter(points, point_time)
+                writer.write(points)
 
-base_url = 'https://eu5.fusionsolar.huawei.com/thirdData/'
-login_credentials = { "userName": config["fusionsolar"]["userName"], "systemCode": config["fusionsolar"]["systemCode"]}
 
-# Define the measurement name
-measurement_name = "getDevRealKpi"
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    profiler.add_arguments(arg_parser)
+    args = arg_parser.parse_args()
+    profiler.setup(args)
 
-s = requests.session()
+    # Load the configuration from local.json
+    with open('local.json', 'r') as json_file:
+        config = json.load(json_file)
 
-def login_to_huawei(s):
-    response = s.post(base_url + 'login', json=login_credentials)
+    # Set up the InfluxDB client
+    client = connect_influxdb(config)
 
-    if response.status_code == 200: 
-        # {'data': None, 'success': True, 'failCode': 0, 'params': {}, 'message': None}
-        data = response.json()
-        if data['success'] != True:
-            print('Error at login. Credentials error?')
-            if data['message'] != None:
-                print(data['Message'])
-            else:
-                print(data)
-            exit()
-        print("Login successful")
-        s.headers['XSRF-TOKEN'] = s.cookies.get('XSRF-TOKEN')
-        return s
-    else:
-        print('Error at login:', response.status_code, response.json())
-
-s = login_to_huawei(s)
-
-url = base_url + 'getStationList'
-response = s.post(url)
-# print('getStationList\n' + json.dumps(response.json(), indent=1) + '\n\n')
-
-stationCodes = []
-for station in response.json()['data']:
-    stationCodes.append(station['stationCode'])
-
-# Get a write API instance for the bucket
-write_api = client.write_api(write_options=SYNCHRONOUS)
-write_api = client.write_api(bucket=bucket_name)
-
-epoch_time = int(time.time())
-query_time = datetime.datetime(2022, 9, 1, 22, 0, 0).replace(tzinfo=pytz.utc)
-
-for stationCode in stationCodes:
-    url = base_url + 'getDevList'
-    response = s.post(url, json={ "stationCodes": stationCode, "collectTime": int(query_time.timestamp() * 1000) })
-    print('getDevList\n' + json.dumps(response.json(), indent=1) + '\n\n')
-
-for devList in response.json()['data']:
-    devId = devList['id']
-    devTypeId = devList['devTypeId']
-    if devTypeId not in [1, 10, 17, 38, 39, 41, 47]: # The following device types are supported
-      continue
-    stationCode = devList['stationCode']
-    # Query InfluxDB to get the latest time entry was saved in that stationCode
-    # query_api = client.query_api()
-    # query = (f'from(bucket:"{bucket_name}")'
-              # ' |> range(start: 0, stop: now())'
-             # f' |> filter(fn: (r) => r["_measurement"] == "{measurement_name}")'
-             # f' |> filter(fn: (r) => r["stationCode"] == "{stationCode}")'
-              # ' |> sort(columns: ["_time"])'
-              # ' |> last()')
-    # result = query_api.query(query)
-
-    # if result and result[0].records:
-        # query_time = result[0].records[0]['_time']
-
-    # while query_time < datetime.datetime.utcnow().replace(tzinfo=pytz.utc):
-    url = base_url + measurement_name
-    while True:
-        response = s.post(url, json={ "devTypeId": devTypeId, "devIds": devId })
-        retry_delay = 30
-        if response.status_code != 200:
-            print(f"Received != 200 status code. Retrying in {retry_delay} seconds... Status code {response.status_code}. Url: {url}")
-            time.sleep(retry_delay)            
-        elif response.json()['failCode'] == 407:
-            print(f"Received 407 status code, we are being rate limited. Retrying in {retry_delay} seconds...")
-            time.sleep(retry_delay)
-        else:
-            data = response.json()
-            break
-    data = response.json()
-    # print(measurement_name + '\n' + json.dumps(data, indent=1) + '\n\n')
-
-    now = int(time.time() * 1000) # Get the current time in milliseconds
-    # Round down to the nearest 5 minutes
-    prev_time = now - (now % (5*60*1000))
-
-
-    if "data" not in data:
-        # print(f"Error: data not found in response, status code {response.status_code}")
-        if response.status_code == 200:
-            if data['failCode'] == 305 and data['message'] == 'USER_MUST_RELOGIN':
-                print('User must re-login')
-                # Re-logging will kick previous login, if you are relogging too much it's probably
-                # someone or something else using the API too, like a crontab
-                s = login_to_huawei(s)
-                query_time -= datetime.timedelta(days=1)
-            else:
-                print(data)
-    else:
-        print(data)
-        # Iterate over each entry in the JSON data and create a point for each one
-        for entry in data["data"]:
-            print(entry)
-            print("Saving data") # from: " + str(datetime.datetime.fromtimestamp(entry["collectTime"]/1000).strftime('%Y-%m-%d %H:%M:%S')) + ' (' + str(entry["collectTime"]/1000) + ')')
-            # Create a new point for the entry
-            point = Point(measurement_name) \
-                .tag("stationCode", stationCode) \
-                .tag("devId", devId) \
-                .tag("devTypeId", devTypeId) \
-                .tag("sns", entry["sn"])
-
-            for key, value in entry["dataItemMap"].items():
-                point.field(key, value)
-
-            point.time(data["params"]["currentTime"], WritePrecision.MS)
-
-            # # Write the point to the bucket
-            write_api.write(bucket=bucket_name, record=point)
-
-        # query_time += relativedelta(months=1)
-        # query_time = query_time.replace(day=1) # Should be improved
-
-# Close the write API connection
-write_api.__del__()
+    fs = FusionSolarClient(config)
+    fs.login()
+
+    stationCodes = fs.get_station_codes()
+
+    # Buffer the points and write them to the bucket in batches
+    writer = BatchWriter(client, config)
+
+    # Export the metrics of the run, if "metrics" is set in local.json
+    metrics.setup(config)
+
+    # Devices of every station, getDevList is only called for the stations whose devices are too old
+    inventory = DeviceInventory(fs, config)
+    inventory.refresh(stationCodes)
+
+    # Only the fields that changed since the last run are written, if "dedup" is set in local.json
+    dedup = ChangeFilter(config, 'getDevRealKpi')
+
+    # The following device types are supported
+    poll_dev_real_kpi(fs, writer, inventory.devices(supported_dev_types), dedup=dedup)
+    writer.on_flush(dedup.save)
+
+    # Write the remaining points and close the write API connection
+    writer.close()
@@ -1,129 +1,104 @@
 #!/usr/bin/python3
 
-from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client import Point, WritePrecision
+from points import station_kpi_points
+from influx_writer import connect_influxdb, BatchWriter
+import metrics
+import profiler
+from watermarks import WatermarkStore
 import json
-import requests
 import time
 import datetime 
 from dateutil import parser
 import pytz
+import argparse
+from fusionsolar import FusionSolarClient, batches, max_station_codes, kpi_periods, period_start, collect_time
+import backfill
+from backfill import run_backfill, split_windows
+from gaps import load_gaps
+
+arg_parser = argparse.ArgumentParser()
+backfill.add_arguments(arg_parser)
+arg_parser.add_argument('--gaps', help='Only fetch the missing days of the work list written by gaps.py')
+profiler.add_arguments(arg_parser)
+args = arg_parser.parse_args()
+profiler.setup(args)
 
 # Load the configuration from local.json
 with open('local.json', 'r') as json_file:
     config = json.load(json_file)
 
 # Set up the InfluxDB client
-client = InfluxDBClient(url=config['influxdb']['url'], token=config['influxdb']['token'], org=config['influxdb']['org'])
+client = connect_influxdb(config)
 
 # Set the bucket name
 bucket_name = influxdb_org = config['influxdb']['bucket']
 
-base_url = 'https://eu5.fusionsolar.huawei.com/thirdData/'
-login_credentials = { "userName": config["fusionsolar"]["userName"], "systemCode": config["fusionsolar"]["systemCode"]}
-
 # Define the measurement name
 measurement_name = "getKpiStationHour"
 
-s = requests.session()
-
-def login_to_huawei(s):
-    response = s.post(base_url + 'login', json=login_credentials)
-
-    if response.status_code == 200: 
-        # {'data': None, 'success': True, 'failCode': 0, 'params': {}, 'message': None}
-        data = response.json()
-        if data['success'] != True:
-            print('Error at login. Credentials error?')
-            if data['message'] != None:
-                print(data['Message'])
-            else:
-                print(data)
-            exit()
-        print("Login successful")
-        s.headers['XSRF-TOKEN'] = s.cookies.get('XSRF-TOKEN')
-        return s
-    else:
-        print('Error at login:', response.status_code, response.json())
-
-s = login_to_huawei(s)
-
-url = base_url + 'getStationList'
-response = s.post(url)
-# print('getStationList\n' + json.dumps(response.json(), indent=1) + '\n\n')
-
-stationCodes = []
-for station in response.json()['data']:
-    stationCodes.append(station['stationCode'])
-
-# Get a write API instance for the bucket
-write_api = client.write_api(write_options=SYNCHRONOUS)
-write_api = client.write_api(bucket=bucket_name)
+fs = FusionSolarClient(config)
+fs.login()
+
+stationCodes = fs.get_station_codes()
+
+# Buffer the points and write them to the bucket in batches
+writer = BatchWriter(client, config)
+
+# Export the metrics of the run, if "metrics" is set in local.json
+metrics.setup(config)
+
+# Last time saved for every stationCode
+watermarks = WatermarkStore(config, client)
 
 epoch_time = int(time.time())
-query_time = datetime.datetime(2022, 9, 14, 22, 0, 0)
-
-for stationCode in stationCodes:  
-    # Query InfluxDB to get the latest time entry was saved
-    query_api = client.query_api()
-    query = (f'from(bucket:"{bucket_name}")'
-              ' |> range(start: 0, stop: now())'
-             f' |> filter(fn: (r) => r["_measurement"] == "{measurement_name}")'
-             f' |> filter(fn: (r) => r["stationCode"] == "{stationCode}")'
-              ' |> sort(columns: ["_time"])'
-              ' |> last()')
-    result = query_api.query(query)
-
-    if result and result[0].records:
-        query_time = result[0].records[0]['_time']
-
-    while query_time < datetime.datetime.utcnow().replace(tzinfo=pytz.utc):
-        url = base_url + measurement_name
-        while True:
-            response = s.post(url, json={ "stationCodes": stationCode, "collectTime": int(query_time.timestamp() * 1000) })
-            retry_delay = 30
-            if response.status_code != 200:
-                print(f"Received != 200 status code. Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)            
-            elif response.json()['failCode'] == 407:
-                print(f"Received 407 status code, we are being rate limited. Retrying in {retry_delay} seconds... Only " + str((datetime.datetime.utcnow().replace(tzinfo=pytz.utc) - query_time).days) + " days to go!")
-                time.sleep(retry_delay)
-            else:
-                data = response.json()
-                break
-        data = response.json()
-        # print(measurement_name + '\n' + json.dumps(data, indent=1) + '\n\n')
-
-        if "data" not in data:
-            # print(f"Error: data not found in response, status code {response.status_code}")
-            if response.status_code == 200:
-                if data['failCode'] == 305 and data['message'] == 'USER_MUST_RELOGIN':
-                    print('User must re-login')
-                    # Re-logging will kick previous login, if you are relogging too much it's probably
-                    # someone or something else using the API too, like a crontab
-                    s = login_to_huawei(s)
-                    query_time -= datetime.timedelta(days=1)
-                else:
-                    print(data)
-        else:
-            # Iterate over each entry in the JSON data and create a point for each one
-            for entry in data["data"]:
-                print("Saving data from: " + str(datetime.datetime.fromtimestamp(entry["collectTime"]/1000).strftime('%Y-%m-%d %H:%M:%S')) + ' (' + str(entry["collectTime"]/1000) + ')')
-                # Create a new point for the entry
-                point = Point(measurement_name) \
-                    .tag("stationCode", entry["stationCode"]) \
-                    .field("radiation_intensity", entry["dataItemMap"]["radiation_intensity"]) \
-                    .field("inverter_power", entry["dataItemMap"]["inverter_power"]) \
-                    .field("power_profit", entry["dataItemMap"]["power_profit"]) \
-                    .field("theory_power", entry["dataItemMap"]["theory_power"]) \
-                    .field("ongrid_power", entry["dataItemMap"]["ongrid_power"]) \
-                    .time(entry["collectTime"], WritePrecision.MS)
-
-                # Write the point to the bucket
-                write_api.write(bucket=bucket_name, record=point)
-
-        query_time += datetime.timedelta(days=1)
-        time.sleep(2)  
-
-# Close the write API connection
-write_api.__del__()
+start_time = datetime.datetime(2022, 9, 14, 22, 0, 0).replace(tzinfo=pytz.utc)
+
+def fetch_window(window):
+    stationCodeBatch, query_time = window
+    return fs.post(measurement_name, { "stationCodes": ",".join(stationCodeBatch), "collectTime": collect_time(query_time) })
+
+def save_window(window, data):
+    stationCodeBatch, query_time = window
+    # print(measurement_name + '\n' + json.dumps(data, indent=1) + '\n\n')
+    if data.get("data") is None:
+        print(data)
+        return
+
+    print("Saving " + str(len(data["data"])) + " entries from: " + str(query_time))
+    # Build a point for each entry in the JSON data and write them to the bucket
+    writer.write(station_kpi_points(measurement_name, data))
+
+    # Save where to resume every station from once the points are written
+    last_times = {}
+    for entry in data["data"]:
+        last_times[entry["stationCode"]] = max(entry["collectTime"], last_times.get(entry["stationCode"], 0))
+    for stationCode, last_time in last_times.items():
+        writer.on_flush(watermarks.set, measurement_name, last_time, stationCode=stationCode)
+
+# Every window is a (stationCodeBatch, start of the day) tuple
+windows = []
+
+if args.gaps:
+    # Only the missing days found by gaps.py, stations missing the same day are requested together
+    gap_days = {}
+    for gap in load_gaps(args.gaps, measurement_name):
+        for query_time in split_windows(period_start(measurement_name, gap['start']), gap['end'], kpi_periods[measurement_name]):
+            gap_days.setdefault(query_time, []).append(gap['stationCode'])
+    for query_time, gapStationCodes in sorted(gap_days.items()):
+        for stationCodeBatch in batches(gapStationCodes, max_station_codes):
+            windows.append((stationCodeBatch, query_time))
+else:
+    # Up to max_station_codes stations are requested at once
+    for stationCodeBatch in batches(stationCodes, max_station_codes):
+        # Get the latest time entry was saved, the batch resumes from the station that is further behind
+        query_time = min(watermarks.resume(measurement_name, start_time, stationCode=stationCode) for stationCode in stationCodeBatch)
+        # Every response covers a whole period, so we resume from the start of the last period, which may be incomplete
+        for query_time in split_windows(period_start(measurement_name, query_time), datetime.datetime.utcnow().replace(tzinfo=pytz.utc), kpi_periods[measurement_name]):
+            windows.append((stationCodeBatch, query_time))
+
+# The windows are requested concurrently, but they are saved in order
+run_backfill(windows, fetch_window, save_window, backfill.max_in_flight(args, config))
+
+# Write the remaining points and close the write API connection
+writer.close()
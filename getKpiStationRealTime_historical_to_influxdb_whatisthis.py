@@ -1,133 +1,225 @@
 #!/usr/bin/python3
 
-from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client import Point, WritePrecision
+from points import station_real_kpi_points
+from influx_writer import connect_influxdb, BatchWriter
+import metrics
+import profiler
+from watermarks import WatermarkStore
 import json
-import requests
 import time
 import datetime 
 from dateutil import parser
 import pytz
+import argparse
+import numpy as np
+from fusionsolar import FusionSolarClient, realtime_interval
+from device_inventory import DeviceInventory
+import backfill
+from backfill import run_backfill, split_windows
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument('--from-devices', action='store_true', help='Rebuild the station history from the getDevHistoryKpi values already saved, without calling the API')
+arg_parser.add_argument('--start', help='Start of the rebuilt history (YYYY-MM-DD)')
+arg_parser.add_argument('--end', help='End of the rebuilt history (YYYY-MM-DD). By default every station stops at its first getStationRealKpi point from the API')
+backfill.add_arguments(arg_parser)
+profiler.add_arguments(arg_parser)
+args = arg_parser.parse_args()
+profiler.setup(args)
 
 # Load the configuration from local.json
 with open('local.json', 'r') as json_file:
     config = json.load(json_file)
 
 # Set up the InfluxDB client
-client = InfluxDBClient(url=config['influxdb']['url'], token=config['influxdb']['token'], org=config['influxdb']['org'])
+client = connect_influxdb(config)
 
 # Set the bucket name
 bucket_name = influxdb_org = config['influxdb']['bucket']
 
-base_url = 'https://eu5.fusionsolar.huawei.com/thirdData/'
-login_credentials = { "userName": config["fusionsolar"]["userName"], "systemCode": config["fusionsolar"]["systemCode"]}
-
 # Define the measurement name
 measurement_name = "getStationRealKpi"
 
-s = requests.session()
-
-def login_to_huawei(s):
-    response = s.post(base_url + 'login', json=login_credentials)
-
-    if response.status_code == 200: 
-        # {'data': None, 'success': True, 'failCode': 0, 'params': {}, 'message': None}
-        data = response.json()
-        if data['success'] != True:
-            print('Error at login. Credentials error?')
-            if data['message'] != None:
-                print(data['Message'])
-            else:
-                print(data)
-            exit()
-        print("Login successful")
-        s.headers['XSRF-TOKEN'] = s.cookies.get('XSRF-TOKEN')
-        return s
-    else:
-        print('Error at login:', response.status_code, response.json())
-
-s = login_to_huawei(s)
+# Buffer the points and write them to the bucket in batches
+writer = BatchWriter(client, config)
 
-url = base_url + 'getStationList'
-response = s.post(url)
-# print(getStationList + '\n' + json.dumps(response.json(), indent=1) + '\n\n')
+# Export the metrics of the run, if "metrics" is set in local.json
+metrics.setup(config)
 
-stationCodes = []
-for station in response.json()['data']:
-    stationCodes.append(station['stationCode'])
-
-# Get a write API instance for the bucket
-write_api = client.write_api(write_options=SYNCHRONOUS)
-write_api = client.write_api(bucket=bucket_name)
+# Last time saved for every stationCode
+watermarks = WatermarkStore(config, client)
 
 epoch_time = int(time.time())
-query_time = datetime.datetime(2022, 9, 14, 22, 0, 0).replace(tzinfo=pytz.utc)
-
-for stationCode in stationCodes:  
-    # Query InfluxDB to get the latest time entry was saved
-    query_api = client.query_api()
+start_time = datetime.datetime(2022, 9, 14, 22, 0, 0).replace(tzinfo=pytz.utc)
+
+# getDevHistoryKpi fields added up for every station, by devTypeId, and the station field they are saved as
+station_fields = {
+    1: { "active_power": "active_power", "day_cap": "day_power", "total_cap": "total_power" }, # Inverters
+    47: { "active_power": "meter_active_power" }, # Meters
+}
+
+# Days rebuilt with every query
+chunk_length = datetime.timedelta(days=7)
+
+
+@profiler.timed('point build')
+def station_history_points(records, inventory, chunk_start, chunk_end):
+    """
+    Add up the device values of every station, 5 minutes at a time.
+
+    Args:
+    - records (list): (stationCode, devId, field, time, value) of the getDevHistoryKpi values, aligned to 5 minutes.
+    - inventory (DeviceInventory): To know the devTypeId of every devId.
+    - chunk_start (datetime): Start of the rebuilt period.
+    - chunk_end (datetime): End of the rebuilt period.
+
+    Returns:
+    - list: One Point per station and 5 minutes, only where every device of the station in the inventory has a value.
+    """
+    slots = int((chunk_end - chunk_start).total_seconds()) // realtime_interval
+    keys = {} # (stationCode, station field): row of the sums
+    rows, columns, values = [], [], []
+    for stationCode, devId, field, time, value in records:
+        devList = inventory.device(int(devId))
+        if devList is None or field not in station_fields.get(devList['devTypeId'], {}) or value is None:
+            continue
+        row = keys.setdefault((stationCode, station_fields[devList['devTypeId']][field]), len(keys))
+        rows.append(row)
+        columns.append(int((time - chunk_start).total_seconds()) // realtime_interval)
+        values.append(value)
+    if not keys:
+        return []
+
+    # Time-aligned sums of every station and field, and how many devices added to each one
+    flat = np.array(rows) * slots + np.array(columns)
+    sums = np.bincount(flat, weights=np.array(values, dtype=float), minlength=len(keys) * slots).reshape(len(keys), slots)
+    counts = np.bincount(flat, minlength=len(keys) * slots).reshape(len(keys), slots)
+    # Devices of the station that add to every field, a device without values in the whole chunk still counts
+    expected = np.array([sum(1 for devList in inventory.station_devices(stationCode) if field in station_fields.get(devList['devTypeId'], {}).values())
+                         for stationCode, field in keys])
+    complete = counts == expected[:, None]
+
+    fields = {} # (stationCode, slot): fields of the point
+    for (stationCode, field), row in keys.items():
+        for slot in np.flatnonzero(complete[row]):
+            fields.setdefault((stationCode, int(slot)), {})[field] = float(sums[row, slot])
+
+    points = []
+    for (stationCode, slot), values in sorted(fields.items()):
+        point = Point(measurement_name) \
+            .tag("stationCode", stationCode) \
+            .time(int((chunk_start.timestamp() + slot * realtime_interval) * 1000), WritePrecision.MS)
+        for field, value in values.items():
+            point.field(field, value)
+        points.append(point)
+    return points
+
+
+def first_realtime_points(start):
+    """
+    Find the first getStationRealKpi point of every station that came from the API. The rebuilt points don't have
+    real_health_state, so they aren't taken for API ones.
+
+    Args:
+    - start (datetime): Only look from this time.
+
+    Returns:
+    - dict: The time of the first point from the API, by stationCode.
+    """
     query = (f'from(bucket:"{bucket_name}")'
-              ' |> range(start: 0, stop: now())'
-             f' |> filter(fn: (r) => r["_measurement"] == "{measurement_name}")'
-             f' |> filter(fn: (r) => r["stationCode"] == "{stationCode}")'
-              ' |> sort(columns: ["_time"])'
-              ' |> last()')
-    result = query_api.query(query)
-
-    if result and result[0].records:
-        query_time = result[0].records[0]['_time']
-
-    while query_time < datetime.datetime.utcnow().replace(tzinfo=pytz.utc):
+             f' |> range(start: {start.strftime("%Y-%m-%dT%H:%M:%SZ")})'
+             f' |> filter(fn: (r) => r["_measurement"] == "{measurement_name}" and r["_field"] == "real_health_state")'
+             ' |> first()')
+    return { record.values["stationCode"]: record.get_time() for table in client.query_api().query(query) for record in table.records }
+
+
+if args.from_devices:
+    # Only the cached inventory is used, there are no API calls in this mode
+    inventory = DeviceInventory(None, config)
+    if not inventory.stations:
+        print(f"The device inventory {inventory.inventory_file} is missing or empty, run getDevHistoryKpi.py or the realtime daemon first")
+        exit(1)
+    device_fields = sorted({ field for fields in station_fields.values() for field in fields })
+    field_filter = ' or '.join(f'r["_field"] == "{field}"' for field in device_fields)
+
+    # Every station goes on after its watermark, unless --start rebuilds them all again from that day
+    if args.start:
+        start = datetime.datetime.strptime(args.start, '%Y-%m-%d').replace(tzinfo=pytz.utc)
+        station_start = { stationCode: start for stationCode in inventory.stations }
+    else:
+        station_start = {}
+        for stationCode in inventory.stations:
+            last_time = watermarks.get(measurement_name, stationCode=stationCode)
+            station_start[stationCode] = last_time + datetime.timedelta(seconds=realtime_interval) if last_time else start_time
+    chunk_start = min(station_start.values())
+    station_end = {}
+    if args.end:
+        end_time = datetime.datetime.strptime(args.end, '%Y-%m-%d').replace(tzinfo=pytz.utc)
+    else:
+        # The rebuilt points are on the same 5 minute grid as the ones of the poller, so every station stops where
+        # the API points start and they aren't overwritten with the sums of the devices
+        station_end = first_realtime_points(chunk_start)
+        end_time = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        if station_end and all(stationCode in station_end for stationCode in inventory.stations):
+            end_time = min(end_time, max(station_end.values()))
+    while chunk_start < end_time:
+        chunk_end = min(chunk_start + chunk_length, end_time)
+        query = (f'from(bucket:"{bucket_name}")'
+                 f' |> range(start: {chunk_start.strftime("%Y-%m-%dT%H:%M:%SZ")}, stop: {chunk_end.strftime("%Y-%m-%dT%H:%M:%SZ")})'
+                 f' |> filter(fn: (r) => r["_measurement"] == "getDevHistoryKpi")'
+                 f' |> filter(fn: (r) => {field_filter})'
+                 f' |> aggregateWindow(every: 5m, fn: last, createEmpty: false, timeSrc: "_start")')
+        records = [(record.values["stationCode"], record.values["devId"], record.get_field(), record.get_time(), record.get_value())
+                   for table in client.query_api().query(query) for record in table.records]
+
+        points = station_history_points(records, inventory, chunk_start, chunk_end)
+        points = [point for point in points if point._time >= station_start[point._tags["stationCode"]].timestamp() * 1000
+                  and (point._tags["stationCode"] not in station_end or point._time < station_end[point._tags["stationCode"]].timestamp() * 1000)]
+        print("Saving " + str(len(points)) + " rebuilt points from: " + str(chunk_start))
+        writer.write(points)
+
+        # Save where to resume every station from once the points are written
+        last_times = {}
+        for point in points:
+            last_times[point._tags["stationCode"]] = point._time
+        for stationCode, last_time in last_times.items():
+            writer.on_flush(watermarks.set, measurement_name, last_time, stationCode=stationCode)
+
+        chunk_start = chunk_end
+else:
+    fs = FusionSolarClient(config)
+    fs.login()
+
+    stationCodes = fs.get_station_codes()
+
+    # Every window is a (stationCode, collectTime) tuple, the 5 minutes of every station in order
+    windows = []
+    for stationCode in stationCodes:  
+        # Get the latest time entry was saved
+        query_time = watermarks.resume(measurement_name, start_time, stationCode=stationCode)
+        for query_time in split_windows(query_time, datetime.datetime.utcnow().replace(tzinfo=pytz.utc), datetime.timedelta(minutes=5)):
+            windows.append((stationCode, query_time))
+
+    def fetch_window(window):
+        stationCode, query_time = window
+        return fs.post(measurement_name, { "stationCodes": stationCode, "collectTime": int(query_time.timestamp() * 1000) })
+
+    def save_window(window, data):
+        stationCode, query_time = window
         print(query_time)
-        url = base_url + measurement_name
-        while True:
-            response = s.post(url, json={ "stationCodes": stationCode, "collectTime": int(query_time.timestamp() * 1000) })
-            retry_delay = 30
-            if response.status_code != 200:
-                print(f"Received != 200 status code. Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)            
-            elif response.json()['failCode'] == 407:
-                print(f"Received 407 status code, we are being rate limited. Retrying in {retry_delay} seconds... Only " + str((datetime.datetime.utcnow().replace(tzinfo=pytz.utc) - query_time).hours) + " hours to go!")
-                time.sleep(retry_delay)
-            else:
-                data = response.json()
-                break
-        data = response.json()
         # print(measurement_name + '\n' + json.dumps(data, indent=1) + '\n\n')
+        print(data)
+        if data.get("data") is None:
+            return
+
+        # Build a point for each entry in the JSON data and write them to the bucket
+        writer.write(station_real_kpi_points(data, data["params"]["currentTime"]))
+
+        # Save where to resume from once the points are written
+        writer.on_flush(watermarks.set, measurement_name, data["params"]["currentTime"], stationCode=stationCode)
+
+    # The windows are requested concurrently, but they are saved in order
+    run_backfill(windows, fetch_window, save_window, backfill.max_in_flight(args, config))
 
-        if "data" not in data:
-            # print(f"Error: data not found in response, status code {response.status_code}")
-            if response.status_code == 200:
-                if data['failCode'] == 305 and data['message'] == 'USER_MUST_RELOGIN':
-                    print('User must re-login')
-                    # Re-logging will kick previous login, if you are relogging too much it's probably
-                    # someone or something else using the API too, like a crontab
-                    s = login_to_huawei(s)
-                    query_time -= datetime.timedelta(days=1)
-                else:
-                    print(data)
-        else:
-            # Iterate over each entry in the JSON data and create a point for each one
-            print(data)
-            for entry in data["data"]:
-                #print("Saving data from: " + str(datetime.datetime.fromtimestamp(entry["collectTime"]/1000).strftime('%Y-%m-%d %H:%M:%S')) + ' (' + str(entry["collectTime"]/1000) + ')')
-                print(entry)
-                # Create a new point for the entry
-                point = Point(measurement_name) \
-                    .tag("stationCode", entry["stationCode"]) \
-                    .field("total_income", entry["dataItemMap"].get("total_income")) \
-                    .field("total_power", entry["dataItemMap"].get("total_power")) \
-                    .field("day_power", entry["dataItemMap"].get("day_power")) \
-                    .field("day_income", entry["dataItemMap"].get("day_income")) \
-                    .field("real_health_state", entry["dataItemMap"].get("real_health_state")) \
-                    .field("month_power", entry["dataItemMap"].get("month_power")) \
-                    .time(data["params"]["currentTime"], WritePrecision.MS)
-
-                # Write the point to the bucket
-                write_api.write(bucket=bucket_name, record=point)
-
-        query_time += datetime.timedelta(minutes=5)
-        time.sleep(2)  
-
-# Close the write API connection
-write_api.__del__()
+# Write the remaining points and close the write API connection
+writer.close()
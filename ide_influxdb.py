@@ -3,16 +3,32 @@
 import requests
 import time
 import json
-from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client import Point, WritePrecision
+from influx_writer import connect_influxdb, BatchWriter
+import metrics
+import argparse
+import profiler
+from watermarks import WatermarkStore
+from archive import ResponseArchive
+from points import ide_points
+from retry import RetryPolicy
 from datetime import datetime, timedelta, timezone
 
+arg_parser = argparse.ArgumentParser()
+profiler.add_arguments(arg_parser)
+args = arg_parser.parse_args()
+profiler.setup(args)
+
+# Load the configuration from local.json
+with open('local.json', 'r') as json_file:
+    config = json.load(json_file)
+
 # Ide Credentials:
 username = config["ide"]["username"]
 password = config["ide"]["password"]
 
 # Set up the InfluxDB client
-client = InfluxDBClient(url=config['influxdb']['url'], token=config['influxdb']['token'], org=config['influxdb']['org'])
+client = connect_influxdb(config)
 
 # Set the bucket name
 bucket_name = config['influxdb']['bucket']
@@ -20,47 +36,49 @@ bucket_name = config['influxdb']['bucket']
 # Define the measurement name
 measurement_name = "ide"
 
+# Backoff and circuit breaker for the failed requests
+retry = RetryPolicy(config, "https://www.i-de.es/")
+
 s = requests.session()
-s.post("https://www.i-de.es/consumidores/rest/loginNew/login", json=[username,password,"null","Windows 10","PC","Firefox 112.0","0","","n"], headers={"dispositivo": "desktop", "AppVersion": "v2"}, cookies={"COOKIE_SUPPORT": "true", "GUEST_LANGUAGE_ID": "es_ES", "leyAnticookies": "true"})
+retry.call(lambda: s.post("https://www.i-de.es/consumidores/rest/loginNew/login", json=[username,password,"null","Windows 10","PC","Firefox 112.0","0","","n"], headers={"dispositivo": "desktop", "AppVersion": "v2"}, cookies={"COOKIE_SUPPORT": "true", "GUEST_LANGUAGE_ID": "es_ES", "leyAnticookies": "true"}, timeout=retry.timeout), "login")
 # We iterate over the contract list
-r = s.get("https://www.i-de.es/consumidores/rest/cto/listaCtos/", params={"_": str(int(time.time() * 1000))}, headers={"dispositivo": "desktop", "AppVersion": "v2"}) 
+r = retry.call(lambda: s.get("https://www.i-de.es/consumidores/rest/cto/listaCtos/", params={"_": str(int(time.time() * 1000))}, headers={"dispositivo": "desktop", "AppVersion": "v2"}, timeout=retry.timeout), "listaCtos")
 
 # Get yesterday's date
 yesterday = (datetime.today() - timedelta(days=1)).strftime('%d-%m-%Y')
 
-# Get a write API instance for the bucket
-write_api = client.write_api(write_options=SYNCHRONOUS)
-write_api = client.write_api(bucket=bucket_name)
+# Buffer the points and write them to the bucket in batches
+writer = BatchWriter(client, config)
+
+# Export the metrics of the run, if "metrics" is set in local.json
+metrics.setup(config)
+
+# Last time saved for every cups
+watermarks = WatermarkStore(config, client)
+
+# Raw copy of every response, if "archive" is set in local.json
+archive = ResponseArchive(config, 'ide')
 
 for contrato in r.json()["contratos"]:
     codContrato = contrato["codContrato"]
     cups = contrato['cups']
-    s.get("https://www.i-de.es/consumidores/rest/cto/seleccion/" + codContrato, headers={"dispositivo": "desktop", "AppVersion": "v2"}, cookies={"COOKIE_SUPPORT": "true", "GUEST_LANGUAGE_ID": "es_ES", "leyAnticookies": "true"})
+    retry.call(lambda: s.get("https://www.i-de.es/consumidores/rest/cto/seleccion/" + codContrato, headers={"dispositivo": "desktop", "AppVersion": "v2"}, cookies={"COOKIE_SUPPORT": "true", "GUEST_LANGUAGE_ID": "es_ES", "leyAnticookies": "true"}, timeout=retry.timeout), "seleccion")
 
-    r = s.get('https://www.i-de.es/consumidores/rest/consumoNew/obtenerLimiteFechasConsumo', headers={"dispositivo": "desktop", "AppVersion": "v2"}, cookies={"COOKIE_SUPPORT": "true", "GUEST_LANGUAGE_ID": "es_ES", "leyAnticookies": "true"})
+    r = retry.call(lambda: s.get('https://www.i-de.es/consumidores/rest/consumoNew/obtenerLimiteFechasConsumo', headers={"dispositivo": "desktop", "AppVersion": "v2"}, cookies={"COOKIE_SUPPORT": "true", "GUEST_LANGUAGE_ID": "es_ES", "leyAnticookies": "true"}, timeout=retry.timeout), "obtenerLimiteFechasConsumo")
     # Example response: {'diferenciaMinima': '2004', 'rangoMaximo': '12', 'fechaMaxima': '27-06-202300:00:00', 'diferenciaMaxima': '1', 'fechaMinima': '01-01-201800:00:00'}
     fechaMínima = datetime.strptime(r.json()['fechaMinima'], '%d-%m-%Y%H:%M:%S')
     fechaMáxima = datetime.strptime(r.json()['fechaMaxima'], '%d-%m-%Y%H:%M:%S')
     if contrato["tipUsoEnergiaCorto"] != "-": # Autoconsumo: obtenerDatosProduccionDH
         # First, we check if yesterday total wasn't 0 to see if there is energy generation in this contract:
         date_str = fechaMáxima.strftime('%d-%m-%Y')
-        r = s.get("https://www.i-de.es/consumidores/rest/consumoNew/obtenerDatosProduccionDH/{}/{}/horas/".format(date_str, date_str), headers={"dispositivo": "desktop", "AppVersion": "v2"}, cookies={"COOKIE_SUPPORT": "true", "GUEST_LANGUAGE_ID": "es_ES", "leyAnticookies": "true"})
+        r = retry.call(lambda: s.get("https://www.i-de.es/consumidores/rest/consumoNew/obtenerDatosProduccionDH/{}/{}/horas/".format(date_str, date_str), headers={"dispositivo": "desktop", "AppVersion": "v2"}, cookies={"COOKIE_SUPPORT": "true", "GUEST_LANGUAGE_ID": "es_ES", "leyAnticookies": "true"}, timeout=retry.timeout), "obtenerDatosProduccionDH")
         if r.json()[0]['total'] == 0.0:
             print('Skipping obtenerDatosProduccionDH on cups', cups, "as yesterday's total energy generation was 0")
         else:
-            # We check in influxdb for the last date we have data from and we request from the following day until fechaMáxima (aka yesterday)
-            query_api = client.query_api()
-            query = (f'from(bucket:"{bucket_name}")'
-                      ' |> range(start: 0, stop: now())'
-                     f' |> filter(fn: (r) => r["_measurement"] == "{measurement_name}")'
-                     f' |> filter(fn: (r) => r["cups"] == "{cups}")'
-                     f' |> filter(fn: (r) => r["frequency"] == "day")'
-                      ' |> sort(columns: ["_time"])'
-                      ' |> last()')
-            result = query_api.query(query)
-
-            if result and result[0].records:
-                dateToCheck = result[0].records[0]['_time']
+            # We check for the last date we have data from and we request from the following day until fechaMáxima (aka yesterday)
+            dateToCheck = watermarks.resume(measurement_name, fechaMínima, cups=cups, frequency='day')
+
+            if dateToCheck != fechaMínima.replace(tzinfo=timezone.utc):
                 dateToCheck = dateToCheck.astimezone(timezone.utc).replace(tzinfo=None)
                 print("Found previous values in filter " + measurement_name + " for " + cups + ". Using timer after previous last value: " + str(dateToCheck))
             else:
@@ -68,98 +86,33 @@ for contrato in r.json()["contratos"]:
                 print("There are no previous " + measurement_name + " values for " + cups + ". Using fechaMínima given by the ide: " + str(dateToCheck))
             while dateToCheck <= fechaMáxima:
                 date_str = dateToCheck.strftime('%d-%m-%Y')
-                r = s.get("https://www.i-de.es/consumidores/rest/consumoNew/obtenerDatosProduccionDH/{}/{}/horas/".format(date_str, date_str), headers={"dispositivo": "desktop", "AppVersion": "v2"}, cookies={"COOKIE_SUPPORT": "true", "GUEST_LANGUAGE_ID": "es_ES", "leyAnticookies": "true"})
-
-                if r.status_code != 200:
-                    print("Request failed with status code " + str(int(r.status_code)) + ". Date we tried: " + date_str + ". Retrying in 5 seconds...")
-                    time.sleep(5)  # Wait for 5 seconds before retrying
-                    continue
+                r = retry.call(lambda: s.get("https://www.i-de.es/consumidores/rest/consumoNew/obtenerDatosProduccionDH/{}/{}/horas/".format(date_str, date_str), headers={"dispositivo": "desktop", "AppVersion": "v2"}, cookies={"COOKIE_SUPPORT": "true", "GUEST_LANGUAGE_ID": "es_ES", "leyAnticookies": "true"}, timeout=retry.timeout), "obtenerDatosProduccionDH")
 
-                print(r.json())
+                # The response is decoded once, for the log, the archive and the points
+                with profiler.phase('JSON decode'):
+                    entries = r.json()
+                print(entries)
+                archive.record('obtenerDatosProduccionDH', { "cups": cups, "fechaDesde": date_str, "fechaHasta": date_str, "frecuencia": "horas" }, entries)
 
                 # Increment the date by one day
                 dateToCheck += timedelta(days=1)
-                time.sleep(1) # To avoid hugging too hard
-
-                for entry in r.json():
-                    try:
-                        # Save one daily value
-                        timestamp = datetime.strptime(entry['fechaDesde'], '%d-%m-%Y')
-                        # Create a new point for the entry
-                        point = Point(measurement_name) \
-                            .tag("cups", entry['cups']) \
-                            .tag("apiUrl", 'obtenerDatosProduccionDH') \
-                            .tag("frequency", 'day')
-
-                        point.time(int(timestamp.timestamp()), WritePrecision.S)
-
-                        exclude_keys = [
-                            "valoresPeriodosTarifarios",
-                            "totalesPeriodosTarifarios",
-                            "fechaDesde",
-                            "fechaHasta",
-                            "periodos",
-                            "valores",
-                            "cups"
-                        ]
-
-                        for key, value in entry.items():
-                            if key == 'totalesPeriodosTarifarios':
-                                for i, n in enumerate(entry[key]):
-                                    # print(entry['periodos'][i], n)
-                                    point.field(entry['periodos'][i], n)
-                            elif key not in exclude_keys:
-                                point.field(key, value)
-
-                        # Write the point to the bucket
-                        print("Saving daily data  | CUPS:", entry['cups'], "Fecha:", timestamp, 'maximo', entry['maximo'], 'posicionMaximo', entry['posicionMaximo'], 'periodoTarifarioMaximo', entry['periodoTarifarioMaximo'], 'total', entry['total']) 
-                        write_api.write(bucket=bucket_name, record=point)
-
-                        # Save one value for each hour: timepoint, value, periodo (punta, llano, valle)
-                        for i, n in enumerate(entry['valoresPeriodosTarifarios']):
-                            timestamp = datetime.strptime(entry['fechaDesde'], '%d-%m-%Y') + timedelta(hours=i+1)
-                            for j, m in enumerate(n):
-                                if m != None:
-                                    periodo = entry['periodos'][j]
-                                    break
-
-                            # timestamp = datetime.strptime(entry['fechaDesde'], '%d-%m-%Y')
-                            # Create a new point for the entry
-                            point = Point(measurement_name) \
-                                .tag("cups", entry['cups']) \
-                                .tag("apiUrl", 'obtenerDatosProduccionDH') \
-                                .tag("frequency", 'hour')
-
-                            point.time(int(timestamp.timestamp()), WritePrecision.S)
-
-                            exclude_keys = [
-                                "valoresPeriodosTarifarios",
-                                "totalesPeriodosTarifarios",
-                                "fechaDesde",
-                                "fechaHasta",
-                                "periodos",
-                                "valores",
-                                "cups"
-                            ]
-
-                            for key, value in entry.items():
-                                if key == 'totalesPeriodosTarifarios':
-                                    for i, n in enumerate(entry[key]):
-                                        point.field(entry['periodos'][i], n)
-                                elif key not in exclude_keys:
-                                    point.field(key, value)
-
-                            point.field("periodos", periodo)
-
-                            # Write the point to the bucket
-                            print("Saving hourly data | CUPS:", entry['cups'], "Fecha:", timestamp, m, periodo)
-                            write_api.write(bucket=bucket_name, record=point)
-                    except:
-                        print(r.status_code)
-                        print(r.json())
+                with profiler.phase('sleep'):
+                    time.sleep(1) # To avoid hugging too hard
+
+                for entry in entries:
+                    print("Saving daily data  | CUPS:", entry.get('cups'), "Fecha:", entry.get('fechaDesde'), 'maximo', entry.get('maximo'), 'posicionMaximo', entry.get('posicionMaximo'), 'periodoTarifarioMaximo', entry.get('periodoTarifarioMaximo'), 'total', entry.get('total'))
+                # Build the daily and hourly points and write them to the bucket
+                writer.write(ide_points(entries))
+
+                # Save where to resume from once the points are written
+                days = [datetime.strptime(entry['fechaDesde'], '%d-%m-%Y') for entry in entries if 'fechaDesde' in entry]
+                if days:
+                    writer.on_flush(watermarks.set, measurement_name, int(max(days).timestamp() * 1000), cups=cups, frequency='day')
 
     # else:
         # print("Contrato", codContrato, "no es de autoconsumo")
 
-write_api.__del__()
+# Write the remaining points and close the write API connection
+writer.close()
+archive.close()
 exit()
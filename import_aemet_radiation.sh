@@ -1,10 +1,5 @@
 #!/bin/bash
 
-# Loop over the files that match the pattern
-for file in radiaciondiaria_*.csv; do
-    # Build the command string with the current file name
-    cmd="python3 aemet_radiacion.py --filename $file"
-
-    # Run the command
-    $cmd
-done
+# Import every file that matches the pattern in a single run, aemet_radiacion.py expands the pattern itself
+# and parses the files in parallel
+python3 aemet_radiacion.py --filename 'radiaciondiaria_*.csv'
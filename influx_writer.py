@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+
+# Batched writes to InfluxDB shared by all the ingestion scripts. Points are buffered and sent in a single
+# write call per batch instead of one HTTP request per point.
+#
+# Optional settings in the "influxdb" section of local.json:
+#   "batch_size": 5000      Maximum number of points sent in a single write
+#   "flush_interval": 10    Seconds after which buffered points are written even if the batch isn't full
+#   "gzip": true            Compress the write requests
+
+from influxdb_client import InfluxDBClient, Point, WritePrecision
+from influxdb_client.client.write_api import SYNCHRONOUS
+import itertools
+import time
+import metrics
+import profiler
+
+
+def connect_influxdb(config):
+    """
+    Set up the InfluxDB client from the configuration loaded from local.json.
+
+    Args:
+    - config (dict): The configuration loaded from local.json.
+
+    Returns:
+    - InfluxDBClient: The client, with gzip enabled unless "gzip" is false.
+    """
+    return InfluxDBClient(url=config['influxdb']['url'], token=config['influxdb']['token'], org=config['influxdb']['org'],
+                          enable_gzip=config['influxdb'].get('gzip', True))
+
+
+def line_protocol(records):
+    """
+    Serialize the points of a batch, grouped by write precision as every write request has a single one.
+
+    Args:
+    - records (list): Points, line protocol strings or dicts.
+
+    Returns:
+    - dict: The line protocol lines of every write precision.
+    """
+    lines = {}
+    for record in records:
+        if isinstance(record, dict):
+            record = Point.from_dict(record)
+        if isinstance(record, Point):
+            line = record.to_line_protocol()
+            if line:
+                lines.setdefault(record._write_precision, []).append(line)
+        else:
+            lines.setdefault(WritePrecision.NS, []).append(record)
+    return lines
+
+
+class BatchWriter:
+    """
+    Buffer points and write them to the bucket in batches.
+
+    Args:
+    - client (InfluxDBClient): The InfluxDB client.
+    - config (dict): The configuration loaded from local.json.
+    """
+
+    def __init__(self, client, config):
+        self.bucket_name = config['influxdb']['bucket']
+        self.batch_size = config['influxdb'].get('batch_size', 5000)
+        self.flush_interval = config['influxdb'].get('flush_interval', 10)
+        self.write_api = client.write_api(write_options=SYNCHRONOUS)
+        self.points = []
+        self.callbacks = []
+        self.last_flush = time.monotonic()
+
+    def write(self, record):
+        """
+        Add a point (or a list of points) to the buffer, writing the buffer if it's full or too old.
+
+        Args:
+        - record: A Point, a line protocol string, a dict or a list of them.
+        """
+        if isinstance(record, list):
+            self.points.extend(record)
+            metrics.inc('tfg_points_built_total', len(record))
+        else:
+            self.points.append(record)
+            metrics.inc('tfg_points_built_total')
+
+        if len(self.points) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def write_stream(self, points):
+        """
+        Write the points of a generator as they are built, a batch at a time, so a long stream is never held in
+        memory whole.
+
+        Args:
+        - points (iterable): The Points, line protocol strings or dicts.
+
+        Returns:
+        - int: The number of points.
+        """
+        count = 0
+        points = iter(points)
+        for batch in iter(lambda: list(itertools.islice(points, self.batch_size)), []):
+            self.write(batch)
+            count += len(batch)
+        return count
+
+    def on_flush(self, callback, *args, **kwargs):
+        """
+        Run a callback once the points buffered so far have been written, e.g. to save a watermark.
+
+        Args:
+        - callback (callable): The function to call, with the rest of the arguments.
+        """
+        if self.points:
+            self.callbacks.append((callback, args, kwargs))
+        else:
+            callback(*args, **kwargs)
+
+    def flush(self):
+        """
+        Write every buffered point to the bucket and run the callbacks waiting for them. If a write fails, the
+        points that weren't written stay in the buffer and the error is raised.
+        """
+        for i in range(0, len(self.points), self.batch_size):
+            batch = self.points[i:i + self.batch_size]
+            try:
+                with profiler.phase('write'):
+                    # Serialized here, once, so the metrics get the size of what's sent
+                    for write_precision, lines in line_protocol(batch).items():
+                        body = '\n'.join(lines)
+                        with metrics.timer('tfg_write_duration_seconds'):
+                            self.write_api.write(bucket=self.bucket_name, record=body, write_precision=write_precision)
+                        metrics.inc('tfg_points_written_total', len(lines))
+                        metrics.inc('tfg_write_bytes_total', len(body.encode('utf-8')))
+            except Exception:
+                self.points = self.points[i:]
+                raise
+        self.points = []
+        self.last_flush = time.monotonic()
+
+        callbacks, self.callbacks = self.callbacks, []
+        for callback, args, kwargs in callbacks:
+            callback(*args, **kwargs)
+
+    def close(self):
+        """
+        Flush the remaining points and close the write API connection.
+        """
+        self.flush()
+        self.write_api.close()
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+# Ingestion metrics in the Prometheus text format: request latency per endpoint, FusionSolar failCodes, retries,
+# points built and written, write latency and bytes. The realtime daemon serves them on http://127.0.0.1:port/metrics,
+# the cron scripts write them to a node-exporter textfile (<textfile_dir>/<script>.prom) when they exit.
+# Every metric has a collector label with the name of the script.
+#
+# Optional setting in local.json, nothing is exported without it:
+#   "metrics": { "port": 9464, "textfile_dir": "/var/lib/node_exporter/textfile_collector" }
+# Set "host": "0.0.0.0" as well to serve /metrics on every interface, it's only local by default.
+
+import atexit
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import sys
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in seconds
+default_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+descriptions = {
+    "tfg_request_duration_seconds": ("histogram", "Duration of the requests to the upstream APIs"),
+    "tfg_fusionsolar_fail_codes_total": ("counter", "FusionSolar answers with failCode 407 (rate limited) or 305 (relogin)"),
+    "tfg_retries_total": ("counter", "Requests retried because of a non-200 answer or a connection error"),
+    "tfg_points_built_total": ("counter", "Points handed to the writer"),
+    "tfg_points_written_total": ("counter", "Points written to InfluxDB"),
+    "tfg_write_duration_seconds": ("histogram", "Duration of the InfluxDB writes"),
+    "tfg_write_bytes_total": ("counter", "Line protocol bytes written to InfluxDB, before compression"),
+}
+
+collector = os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'python'
+lock = threading.Lock()
+counters = {}
+histograms = {}
+
+
+def labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    """
+    Add to a counter.
+
+    Args:
+    - name (str): One of the counters in descriptions.
+    - amount (int): How much to add.
+    - labels: The labels of the series, like endpoint='getDevHistoryKpi'.
+    """
+    with lock:
+        key = (name, labels_key(labels))
+        counters[key] = counters.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    """
+    Add a value to a histogram.
+
+    Args:
+    - name (str): One of the histograms in descriptions.
+    - value (float): The observed value, in seconds.
+    - labels: The labels of the series.
+    """
+    with lock:
+        key = (name, labels_key(labels))
+        histogram = histograms.setdefault(key, { "buckets": [0] * len(default_buckets), "sum": 0.0, "count": 0 })
+        for i, bound in enumerate(default_buckets):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Observe the duration of a block in a histogram.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def format_labels(labels, **extra):
+    labels = dict(labels, collector=collector, **extra)
+    return '{' + ','.join(f'{key}="{str(value)}"' for key, value in sorted(labels.items())) + '}'
+
+
+def render():
+    """
+    Returns:
+    - str: Every metric in the Prometheus text format.
+    """
+    lines = []
+    with lock:
+        for name, (metric_type, description) in descriptions.items():
+            series = [(labels, value) for (metric, labels), value in counters.items() if metric == name]
+            series += [(labels, value) for (metric, labels), value in histograms.items() if metric == name]
+            if not series:
+                continue
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in sorted(series, key=lambda item: item[0]):
+                labels = dict(labels)
+                if metric_type == 'counter':
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+                    continue
+                for bound, count in zip(default_buckets, value['buckets']):
+                    lines.append(f'{name}_bucket{format_labels(labels, le=bound)} {count}')
+                lines.append(f'{name}_bucket{format_labels(labels, le="+Inf")} {value["count"]}')
+                lines.append(f'{name}_sum{format_labels(labels)} {value["sum"]}')
+                lines.append(f'{name}_count{format_labels(labels)} {value["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(textfile_dir):
+    """
+    Write the metrics for the node-exporter textfile collector, atomically so it never reads half a file.
+    """
+    path = os.path.join(textfile_dir, collector + '.prom')
+    with open(path + '.tmp', 'w') as prom_file:
+        prom_file.write(render())
+    os.replace(path + '.tmp', path)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def setup(config, daemon=False):
+    """
+    Export the metrics of this run as set in local.json.
+
+    Args:
+    - config (dict): The configuration loaded from local.json.
+    - daemon (bool): Serve them on /metrics instead of writing the textfile at exit.
+    """
+    settings = config.get('metrics')
+    if settings is None:
+        return
+    if daemon and settings.get('port'):
+        server = ThreadingHTTPServer((settings.get('host', '127.0.0.1'), settings['port']), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    elif settings.get('textfile_dir'):
+        atexit.register(write_textfile, settings['textfile_dir'])
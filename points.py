@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+
+# Builders of the InfluxDB points of every API response. They are shared by the live scripts and replay.py, so
+# an archived response is turned into exactly the same points as a fresh one.
+
+from influxdb_client import Point, WritePrecision
+from datetime import datetime, timedelta, timezone
+import profiler
+
+# Fields saved by the getKpiStation* scripts
+station_kpi_fields = {
+    "getKpiStationHour": ["radiation_intensity", "inverter_power", "power_profit", "theory_power", "ongrid_power"],
+    "getKpiStationDay": ["radiation_intensity", "installed_capacity", "use_power", "inverter_power", "reduction_total_tree",
+                         "power_profit", "theory_power", "reduction_total_coal", "perpower_ratio", "reduction_total_co2",
+                         "ongrid_power", "performance_ratio"],
+}
+station_kpi_fields["getKpiStationMonth"] = station_kpi_fields["getKpiStationDay"]
+station_kpi_fields["getKpiStationYear"] = station_kpi_fields["getKpiStationDay"]
+
+station_real_kpi_fields = ["total_income", "total_power", "day_power", "day_income", "real_health_state", "month_power"]
+
+# REE indicators we know how to save
+ree_indicators = ["1001", "1295", "1739"]
+
+
+@profiler.timed('point build')
+def station_kpi_points(measurement_name, data):
+    """
+    Build the points of a getKpiStationHour/Day/Month/Year response.
+
+    Args:
+    - measurement_name (str): The interface that was called.
+    - data (dict): The decoded JSON response.
+
+    Returns:
+    - list: One Point per station and collectTime.
+    """
+    points = []
+    for entry in data["data"]:
+        point = Point(measurement_name) \
+            .tag("stationCode", entry["stationCode"]) \
+            .time(entry["collectTime"], WritePrecision.MS)
+        for key in station_kpi_fields[measurement_name]:
+            point.field(key, entry["dataItemMap"].get(key))
+        points.append(point)
+    return points
+
+
+@profiler.timed('point build')
+def station_real_kpi_points(data, point_time):
+    """
+    Build the points of a getStationRealKpi response.
+
+    Args:
+    - data (dict): The decoded JSON response.
+    - point_time (int): Time in milliseconds to stamp the points with.
+
+    Returns:
+    - list: One Point per station.
+    """
+    points = []
+    for entry in data["data"]:
+        point = Point("getStationRealKpi") \
+            .tag("stationCode", entry["stationCode"]) \
+            .time(point_time, WritePrecision.MS)
+        for key in station_real_kpi_fields:
+            point.field(key, entry["dataItemMap"].get(key))
+        points.append(point)
+    return points
+
+
+@profiler.timed('point build')
+def dev_kpi_points(measurement_name, data, devStationCodes, point_time=None, devTypeId=None):
+    """
+    Build the points of a getDevRealKpi, getDevHistoryKpi or getDevKpiDay/Month/Year response.
+
+    Args:
+    - measurement_name (str): The interface that was called.
+    - data (dict): The decoded JSON response.
+    - devStationCodes (dict): The stationCode of every devId, as the responses don't include it.
+    - point_time (int): Time in milliseconds to stamp the points with. The collectTime of every entry if None.
+    - devTypeId (int): Saved as a tag if given.
+
+    Returns:
+    - list: One Point per device and collectTime.
+    """
+    points = []
+    for entry in data["data"]:
+        point = Point(measurement_name) \
+            .tag("stationCode", devStationCodes[entry["devId"]]) \
+            .tag("devId", entry["devId"])
+        if devTypeId is not None:
+            point.tag("devTypeId", devTypeId)
+        point.tag("sns", entry["sn"])
+
+        for key, value in entry["dataItemMap"].items():
+            point.field(key, value)
+
+        point.time(entry["collectTime"] if point_time is None else point_time, WritePrecision.MS)
+        points.append(point)
+    return points
+
+
+@profiler.timed('point build')
+def ree_points(data):
+    """
+    Build the points of a REE indicators/ response.
+
+    Args:
+    - data (dict): The decoded JSON response.
+
+    Returns:
+    - list: One Point per value, empty if the indicator isn't supported.
+    """
+    indicator = str(data['indicator']['id'])
+    if indicator not in ree_indicators:
+        print("The code to save to influxdb the indicator", indicator, "is missing")
+        return []
+
+    exclude_keys = [
+        "datetime",
+        "datetime_utc",
+        "tz_time",
+        "geo_ids"
+    ]
+
+    points = []
+    for entry in data["indicator"]["values"]:
+        point = Point("ree") \
+            .tag("indicator", indicator) \
+            .tag("name", data['indicator']['name']) \
+            .tag("short_name", data['indicator']['short_name'])
+
+        # Parse the UTC timestamp string and convert it to a string in RFC3339 format
+        timestamp = datetime.strptime(entry['datetime_utc'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+        point.time(timestamp.isoformat())
+
+        for key, value in entry.items():
+            if key not in exclude_keys:
+                point.field(key, value)
+        points.append(point)
+    return points
+
+
+@profiler.timed('point build')
+def ide_points(entries):
+    """
+    Build the points of an i-DE obtenerDatosProduccionDH response: a daily point and one point for each hour.
+
+    Args:
+    - entries (list): The decoded JSON response.
+
+    Returns:
+    - list: The daily and hourly Points.
+    """
+    exclude_keys = [
+        "valoresPeriodosTarifarios",
+        "totalesPeriodosTarifarios",
+        "fechaDesde",
+        "fechaHasta",
+        "periodos",
+        "valores",
+        "cups"
+    ]
+
+    points = []
+    for entry in entries:
+        try:
+            # Save one daily value
+            timestamp = datetime.strptime(entry['fechaDesde'], '%d-%m-%Y')
+            point = Point("ide") \
+                .tag("cups", entry['cups']) \
+                .tag("apiUrl", 'obtenerDatosProduccionDH') \
+                .tag("frequency", 'day')
+
+            point.time(int(timestamp.timestamp()), WritePrecision.S)
+
+            for key, value in entry.items():
+                if key == 'totalesPeriodosTarifarios':
+                    for i, n in enumerate(entry[key]):
+                        point.field(entry['periodos'][i], n)
+                elif key not in exclude_keys:
+                    point.field(key, value)
+            points.append(point)
+
+            # Save one value for each hour: timepoint, value, periodo (punta, llano, valle)
+            for i, n in enumerate(entry['valoresPeriodosTarifarios']):
+                timestamp = datetime.strptime(entry['fechaDesde'], '%d-%m-%Y') + timedelta(hours=i+1)
+                for j, m in enumerate(n):
+                    if m != None:
+                        periodo = entry['periodos'][j]
+                        break
+
+                point = Point("ide") \
+                    .tag("cups", entry['cups']) \
+                    .tag("apiUrl", 'obtenerDatosProduccionDH') \
+                    .tag("frequency", 'hour')
+
+                point.time(int(timestamp.timestamp()), WritePrecision.S)
+
+                for key, value in entry.items():
+                    if key == 'totalesPeriodosTarifarios':
+                        for k, total in enumerate(entry[key]):
+                            point.field(entry['periodos'][k], total)
+                    elif key not in exclude_keys:
+                        point.field(key, value)
+
+                point.field("periodos", periodo)
+                points.append(point)
+        except:
+            print("Can't save the entry", entry)
+    return points
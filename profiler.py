@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+# Per-phase timing of a run, enabled with --profile on the collectors. Every phase (login, station list,
+# watermark lookup, fetch, JSON decode, point build, write, sleep) adds up its wall time and CPU time, and the
+# table is printed when the run ends. A phase inside another one (the fetch of a relogin) only counts in the inner
+# one, so the phases add up to the time of the run. With --profile-output the run is also profiled with cProfile
+# and the stats are saved for pstats or snakeviz.
+#
+# The phases of the backfill threads are added up too, so with --max-in-flight the wall times of fetch and JSON
+# decode can be longer than the run. cProfile only sees the main thread.
+#
+# Example:
+#   python3 getDevHistoryKpi.py --start 2023-01-01 --profile --profile-output getDevHistoryKpi.pstats
+#   python3 -m pstats getDevHistoryKpi.pstats
+
+import atexit
+import cProfile
+import functools
+import inspect
+import threading
+import time
+
+enabled = False
+lock = threading.Lock()
+local = threading.local()
+# Wall time, CPU time and calls of every phase
+phases = {}
+
+
+class Phase:
+    """
+    Context manager that adds the time spent in its block to a phase.
+
+    Args:
+    - name (str): The phase, like 'fetch' or 'write'.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if not enabled:
+            return self
+        stack = local.__dict__.setdefault('stack', [])
+        # Wall and CPU time of the phases nested in this one, they are subtracted from it
+        self.nested = [0.0, 0.0]
+        stack.append(self)
+        self.start = (time.perf_counter(), time.thread_time())
+        return self
+
+    def __exit__(self, *exc_info):
+        if not enabled or not hasattr(self, 'start'):
+            return False
+        wall = time.perf_counter() - self.start[0]
+        cpu = time.thread_time() - self.start[1]
+        stack = local.stack
+        stack.pop()
+        if stack:
+            stack[-1].nested[0] += wall
+            stack[-1].nested[1] += cpu
+        with lock:
+            totals = phases.setdefault(self.name, [0.0, 0.0, 0])
+            totals[0] += wall - self.nested[0]
+            totals[1] += cpu - self.nested[1]
+            totals[2] += 1
+        return False
+
+
+def phase(name):
+    """
+    Time a block as part of a phase:
+        with profiler.phase('write'):
+            ...
+    """
+    return Phase(name)
+
+
+def timed_iter(name, iterable):
+    """
+    Time every item taken from an iterable as part of a phase, like the lines of a download that is read as the
+    rows are parsed.
+    """
+    if not enabled:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        with Phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def timed(name):
+    """
+    Decorator that times every call of a function as part of a phase. The items of a generator are timed as they
+    are taken.
+    """
+    def decorator(function):
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def generator_wrapper(*args, **kwargs):
+                return timed_iter(name, function(*args, **kwargs))
+            return generator_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with Phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_arguments(arg_parser):
+    """
+    Add --profile and --profile-output to the arguments of a script.
+
+    Args:
+    - arg_parser (ArgumentParser): The parser of the script.
+    """
+    arg_parser.add_argument('--profile', action='store_true', help='Print the wall and CPU time of every phase when the run ends')
+    arg_parser.add_argument('--profile-output', help='Also profile the run with cProfile and save the stats in this file')
+
+
+def setup(args):
+    """
+    Start timing the phases if --profile or --profile-output was given.
+
+    Args:
+    - args (Namespace): The parsed arguments, with the ones of add_arguments.
+    """
+    global enabled
+    if not args.profile and not args.profile_output:
+        return
+    enabled = True
+    start = (time.perf_counter(), time.process_time())
+    profile = None
+    if args.profile_output:
+        profile = cProfile.Profile()
+        profile.enable()
+    atexit.register(report, start, profile, args.profile_output)
+
+
+def report(start, profile=None, profile_output=None):
+    """
+    Print the time of every phase, and save the cProfile stats.
+
+    Args:
+    - start (tuple): Wall and CPU time when the run started.
+    - profile (Profile): The running profiler, if any.
+    - profile_output (str): Where to save its stats.
+    """
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(profile_output)
+        print("Profile saved in", profile_output)
+
+    wall = time.perf_counter() - start[0]
+    cpu = time.process_time() - start[1]
+    with lock:
+        rows = sorted(phases.items(), key=lambda item: item[1][0], reverse=True)
+    print(f"{'Phase':<16}{'Wall (s)':>12}{'CPU (s)':>12}{'Calls':>10}")
+    for name, (phase_wall, phase_cpu, calls) in rows:
+        print(f"{name:<16}{phase_wall:>12.3f}{phase_cpu:>12.3f}{calls:>10}")
+    print(f"{'other':<16}{max(0.0, wall - sum(row[1][0] for row in rows)):>12.3f}{max(0.0, cpu - sum(row[1][1] for row in rows)):>12.3f}")
+    print(f"{'total':<16}{wall:>12.3f}{cpu:>12.3f}")
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+
+# Token bucket rate limiter for the FusionSolar interfaces, shared by every script running at the same time.
+# The state of each interface lives in a small JSON file guarded by a lock file, so all the cron jobs draw
+# from the same bucket. The rate adapts to the quota (AIMD): it grows a little after every accepted request
+# and it's halved every time we get a failCode 407.
+#
+# Optional settings in the "fusionsolar" section of local.json (rates in requests per minute):
+#   "rate_limit": { "dir": ".ratelimit", "initial": 30, "min": 0.5, "max": 600, "increase": 1, "decrease": 0.5, "burst": 1 }
+
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+import profiler
+
+
+class RateLimiter:
+    """
+    Adaptive token bucket per interface, shared between processes.
+
+    Args:
+    - config (dict): The configuration loaded from local.json.
+    """
+
+    def __init__(self, config):
+        settings = config['fusionsolar'].get('rate_limit', {})
+        self.state_dir = settings.get('dir', '.ratelimit')
+        self.initial_rate = settings.get('initial', 30) / 60
+        self.min_rate = settings.get('min', 0.5) / 60
+        self.max_rate = settings.get('max', 600) / 60
+        self.increase = settings.get('increase', 1) / 60
+        self.decrease = settings.get('decrease', 0.5)
+        self.burst = settings.get('burst', 1)
+        os.makedirs(self.state_dir, exist_ok=True)
+
+    @contextmanager
+    def state(self, interface):
+        """
+        Lock the state of an interface and yield it, saving it back when the block ends.
+        """
+        path = os.path.join(self.state_dir, interface)
+        with open(path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(path + '.json', 'r') as json_file:
+                    state = json.load(json_file)
+            except (OSError, ValueError):
+                state = { "rate": self.initial_rate, "tokens": self.burst, "updated": time.time() }
+
+            # Refill the bucket with the tokens earned since the last update
+            now = time.time()
+            state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * state['rate'])
+            state['updated'] = now
+
+            yield state
+
+            with open(path + '.json', 'w') as json_file:
+                json.dump(state, json_file)
+
+    def acquire(self, interface):
+        """
+        Wait until the interface can be called.
+
+        Args:
+        - interface (str): Interface name, like 'getDevHistoryKpi'.
+        """
+        while True:
+            with self.state(interface) as state:
+                if state['tokens'] >= 1:
+                    state['tokens'] -= 1
+                    return
+                wait = (1 - state['tokens']) / state['rate']
+            with profiler.phase('sleep'):
+                time.sleep(wait)
+
+    def success(self, interface):
+        """
+        The request was accepted, raise the rate a little (additive increase).
+        """
+        with self.state(interface) as state:
+            state['rate'] = min(self.max_rate, state['rate'] + self.increase)
+
+    def throttled(self, interface):
+        """
+        We got a failCode 407, halve the rate (multiplicative decrease) and empty the bucket.
+        """
+        with self.state(interface) as state:
+            state['rate'] = max(self.min_rate, state['rate'] * self.decrease)
+            state['tokens'] = min(state['tokens'], 0)
+            print(f"Rate limit for {interface} lowered to {state['rate'] * 60:.2f} requests per minute")
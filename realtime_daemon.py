@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+# Long-running poller for the realtime interfaces (getStationRealKpi and getDevRealKpi), to use instead of the
+# cron jobs of getKpiStationRealTime_to_influxdb.py and getDevRealKpi_to_influxdb.py. It logs in once and keeps
+# the session, and polls on wall-clock-aligned 5 minute ticks (plus a small random jitter so we don't hit the
+# API at the exact same second as everyone else). Every point is stamped with the aligned tick time. A tick whose
+# calls fail (or whose circuit is open) is logged and skipped, the poller goes on with the next one. If InfluxDB
+# can't be written, the points are kept in the buffer and written with the next tick.
+#
+# Optional settings in the "fusionsolar" section of local.json:
+#   "poll_jitter": 30           Maximum seconds to wait after every tick
+#   "device_refresh": 3600      Seconds between refreshes of the station list (and the expired devices)
+#
+# With "metrics": { "port": 9464 } in local.json the ingestion metrics are served on http://127.0.0.1:9464/metrics
+
+import json
+import random
+import signal
+import sys
+import time
+from influx_writer import connect_influxdb, BatchWriter
+import metrics
+import argparse
+import profiler
+from fusionsolar import FusionSolarClient, realtime_interval, supported_dev_types
+from retry import UpstreamError
+from device_inventory import DeviceInventory
+from dedup import ChangeFilter
+from getKpiStationRealTime_to_influxdb import poll_station_real_kpi
+from getDevRealKpi_to_influxdb import poll_dev_real_kpi
+
+
+def next_tick(now, interval=realtime_interval):
+    """
+    Returns:
+    - int: The first epoch time in seconds after now that is a multiple of interval.
+    """
+    return (int(now) // interval + 1) * interval
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    profiler.add_arguments(arg_parser)
+    args = arg_parser.parse_args()
+    profiler.setup(args)
+
+    # Load the configuration from local.json
+    with open('local.json', 'r') as json_file:
+        config = json.load(json_file)
+
+    poll_jitter = config['fusionsolar'].get('poll_jitter', 30)
+    device_refresh = config['fusionsolar'].get('device_refresh', 3600)
+
+    # Set up the InfluxDB client
+    client = connect_influxdb(config)
+
+    fs = FusionSolarClient(config, retry_delay=60)
+    fs.login()
+
+    # Devices of every station, kept up to date with the inventory TTL
+    inventory = DeviceInventory(fs, config)
+
+    # Only the fields that changed since the last tick are written, if "dedup" is set in local.json
+    dedup = ChangeFilter(config)
+
+    # Buffer the points and write them to the bucket in batches
+    writer = BatchWriter(client, config)
+
+    # Serve the metrics on /metrics, if "metrics" is set in local.json
+    metrics.setup(config, daemon=True)
+
+    # Write the pending points when systemd (or anyone else) stops us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    last_refresh = None
+    try:
+        while True:
+            tick = next_tick(time.time())
+            with profiler.phase('sleep'):
+                time.sleep(max(0, tick - time.time()) + random.uniform(0, poll_jitter))
+
+            try:
+                if last_refresh is None or tick - last_refresh >= device_refresh:
+                    stationCodes = fs.get_station_codes()
+                    inventory.refresh(stationCodes)
+                    devices = inventory.devices(supported_dev_types)
+                    last_refresh = tick
+
+                poll_station_real_kpi(fs, writer, stationCodes, tick * 1000, dedup)
+                poll_dev_real_kpi(fs, writer, devices, tick * 1000, dedup)
+            except UpstreamError as e:
+                # The open circuit fails fast, so the ticks are skipped until its open_time has passed
+                print(f"Skipping the tick of {time.ctime(tick)}: {e}")
+            except Exception as e:
+                # Like an answer that isn't JSON, the realtime collection goes on with the next tick
+                print(f"Skipping the tick of {time.ctime(tick)}, unexpected error: {e!r}")
+
+            try:
+                # Don't keep the tick waiting in the buffer until the next one
+                writer.flush()
+            except Exception as e:
+                print(f"Couldn't write the points of the tick of {time.ctime(tick)}, they are kept for the next one: {e!r}")
+    finally:
+        # Write the remaining points and close the write API connection
+        writer.close()
+
+
+if __name__ == '__main__':
+    main()
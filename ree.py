@@ -5,11 +5,23 @@
 
 import requests
 import json
-from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client import Point, WritePrecision
+from influx_writer import connect_influxdb, BatchWriter
+import metrics
+import argparse
+import profiler
+from watermarks import WatermarkStore
+from archive import ResponseArchive
+from points import ree_points
+from retry import RetryPolicy
 from datetime import datetime, timedelta, timezone
 import time
 
+arg_parser = argparse.ArgumentParser()
+profiler.add_arguments(arg_parser)
+args = arg_parser.parse_args()
+profiler.setup(args)
+
 # Load the configuration from local.json
 with open('local.json', 'r') as json_file:
     config = json.load(json_file)
@@ -23,14 +35,25 @@ headers = {
 }
 
 # Set up the InfluxDB client
-client = InfluxDBClient(url=config['influxdb']['url'], token=config['influxdb']['token'], org=config['influxdb']['org'])
+client = connect_influxdb(config)
 
 # Set the bucket name
 bucket_name = config['influxdb']['bucket']
 
-# Get a write API instance for the bucket
-write_api = client.write_api(write_options=SYNCHRONOUS)
-write_api = client.write_api(bucket=bucket_name)
+# Buffer the points and write them to the bucket in batches
+writer = BatchWriter(client, config)
+
+# Export the metrics of the run, if "metrics" is set in local.json
+metrics.setup(config)
+
+# Last time saved for every indicator
+watermarks = WatermarkStore(config, client)
+
+# Raw copy of every response, if "archive" is set in local.json
+archive = ResponseArchive(config, 'ree')
+
+# Backoff and circuit breaker for the failed requests
+retry = RetryPolicy(config, "https://api.esios.ree.es/", base_delay=20)
 
 # Define the measurement name
 measurement_name = "ree"
@@ -43,58 +66,27 @@ indicators = [ "1001", "1295", "1739" ]
 
 def influxdb_save_ree(data):
   indicator = str(data['indicator']['id'])
-  if indicator not in ["1001", "1295", "1739"]:
-    print("The code to save to influxdb the indicator", indicator, "is missing")
-  else:
+  points = ree_points(data)
+  if points:
     for entry in data["indicator"]["values"]:
-      print(json.dumps(entry, indent=4, ensure_ascii=False))
-      # Create a new point for the entry
-      point = Point(measurement_name) \
-        .tag("indicator", indicator) \
-        .tag("name", data['indicator']['name']) \
-        .tag("short_name", data['indicator']['short_name'])
+      print("Saving hourly data | indicator:", indicator, "Fecha:", entry['datetime_utc'], entry['value'])
+    writer.write(points)
 
-      # Parse the UTC timestamp string
-      timestamp = datetime.strptime(entry['datetime_utc'], '%Y-%m-%dT%H:%M:%SZ')
-
-      # Convert the parsed datetime to a UTC aware datetime object
-      utc_aware_time = timestamp.replace(tzinfo=timezone.utc)
-
-      # Convert the UTC aware datetime object to a string in RFC3339 format
-      point.time(utc_aware_time.isoformat())
-
-      exclude_keys = [
-        "datetime",
-        "datetime_utc",
-        "tz_time",
-        "geo_ids"
-      ]
-
-      for key, value in entry.items():
-        if key not in exclude_keys:
-          point.field(key, value)
-
-      # Write the point to the bucket
-      print("Saving hourly data | indicator:", indicator, "Fecha:", timestamp, entry['value'])
-      write_api.write(bucket=bucket_name, record=point)
+    # Save where to resume from once the points are written
+    utc_aware_time = datetime.strptime(data["indicator"]["values"][-1]['datetime_utc'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+    writer.on_flush(watermarks.set, measurement_name, utc_aware_time, indicator=indicator)
 
 for indicator in indicators:
 
-  # Query InfluxDB to know up to which date do we have
-  query_api = client.query_api()
-  query = (f'from(bucket:"{bucket_name}")'
-        ' |> range(start: 0, stop: now())'
-       f' |> filter(fn: (r) => r["_measurement"] == "{measurement_name}")'
-       f' |> filter(fn: (r) => r["indicator"] == "{indicator}")'
-        ' |> sort(columns: ["_time"])'
-        ' |> last()')
-  result = query_api.query(query)
-
-  if result and result[0].records:
-    dateToCheck = result[0].records[0]['_time'] + timedelta(days=1) # previous date + 1 day
+  # Get up to which date do we have
+  defaultDate = datetime(2022, 9, 1, 0, 0, 0, tzinfo=timezone.utc)
+  lastDate = watermarks.resume(measurement_name, defaultDate, indicator=indicator)
+
+  if lastDate != defaultDate:
+    dateToCheck = lastDate + timedelta(days=1) # previous date + 1 day
     print("Found previous values in filter", measurement_name, "for", indicator + ". Using timer after previous last value:", str(dateToCheck))
   else:
-    dateToCheck = datetime(2022, 9, 1, 0, 0, 0, tzinfo=timezone.utc)
+    dateToCheck = defaultDate
     print("There are no previous", measurement_name, "values for", indicator + ". Using default hard coded value:", str(dateToCheck))
 
   yesterday = (datetime.today() - timedelta(days=1)).astimezone(timezone.utc)
@@ -118,19 +110,20 @@ for indicator in indicators:
     if indicator != "1295":
       params["time_trunc"] = "hour"
 
-    r = requests.get("https://api.esios.ree.es/indicators/" + str(indicator), params=params, headers=headers)
+    r = retry.call(lambda: requests.get("https://api.esios.ree.es/indicators/" + str(indicator), params=params, headers=headers, timeout=retry.timeout), "indicators")
 
-    if r.status_code == 200:
-      # Increment the date by one day
-      dateToCheck += timedelta(days=1)
+    # Increment the date by one day
+    dateToCheck += timedelta(days=1)
+    with profiler.phase('JSON decode'):
       data = r.json()
-      # Process the data as needed
-      # print(json.dumps(data, indent=4, ensure_ascii=False))
-      influxdb_save_ree(data)
+    archive.record("indicators/" + str(indicator), params, data)
+    # Process the data as needed
+    # print(json.dumps(data, indent=4, ensure_ascii=False))
+    influxdb_save_ree(data)
+    with profiler.phase('sleep'):
       time.sleep(3) # hug
-    else:
-      print("Request failed with status code:", r.status_code)
-      time.sleep(20)
 
-write_api.__del__()
+# Write the remaining points and close the write API connection
+writer.close()
+archive.close()
 exit()
\ No newline at end of file
@@ -0,0 +1,245 @@
+#!/usr/bin/python3
+
+# Replay the raw responses saved by archive.py (and the daily AEMET radiation CSVs) into InfluxDB without calling
+# any API. The responses go through the same point builders as the live scripts, so after fixing a builder a
+# measurement can be rebuilt from disk. Every segment (or CSV) is replayed by its own worker process.
+#
+# With --aemet the radiation CSVs are replayed too, and so are the archived observations of
+# observacion/convencional/todas (aemet_observacion_convencional). Like aemet_radiacion.py, the observations are only
+# saved for the stations that are in the radiation CSVs.
+#
+# Examples:
+#   python3 replay.py --measurement getDevHistoryKpi --start 2023-01-01 --end 2023-02-01
+#   python3 replay.py --measurement sun_radiation --aemet 'dailyRadData/radiaciondiaria_*.csv'
+
+import argparse
+import glob
+import json
+from datetime import datetime, timezone
+from dateutil import parser
+from multiprocessing import Pool
+from influx_writer import connect_influxdb, BatchWriter
+from archive import default_archive_dir, list_segments, read_segment
+from fusionsolar import align_time
+from device_inventory import default_inventory_file
+from points import station_kpi_fields, station_kpi_points, station_real_kpi_points, dev_kpi_points, ree_points, ide_points
+from aemet_points import process_entry, radiation_points, csv_rows, csv_identifiers
+from aemet_stations import station_index, StationTimezones
+
+# Interfaces whose responses don't include the stationCode of the devices
+dev_kpi_measurements = ["getDevRealKpi", "getDevHistoryKpi", "getDevKpiDay", "getDevKpiMonth", "getDevKpiYear"]
+
+# Measurement written by the REE, i-DE and AEMET responses, for FusionSolar it is the endpoint
+source_measurements = { "ree": "ree", "ide": "ide", "aemet": "aemet_observacion_convencional" }
+
+precisions = { "s": 1, "ms": 1e3, "us": 1e6, "ns": 1e9 }
+
+
+def point_measurement(point):
+    """
+    Returns:
+    - str: The measurement of a Point or of a line protocol string.
+    """
+    if isinstance(point, str):
+        return point.split(',', 1)[0]
+    return point._name
+
+
+def point_time(point):
+    """
+    Returns:
+    - datetime: The time of a Point, or of a line protocol string with the time in nanoseconds, in UTC.
+    """
+    if isinstance(point, str):
+        return datetime.fromtimestamp(int(point.rsplit(' ', 1)[1]) / precisions['ns'], tz=timezone.utc)
+    time = point._time
+    if isinstance(time, str):
+        return parser.isoparse(time)
+    if isinstance(time, datetime):
+        return time if time.tzinfo else time.replace(tzinfo=timezone.utc)
+    return datetime.fromtimestamp(time / precisions[point._write_precision], tz=timezone.utc)
+
+
+def record_points(source, record, devStationCodes, aemetTimezones=None):
+    """
+    Build the points of an archived response, like the script that requested it did.
+
+    Args:
+    - source (str): The directory of the segment, like 'fusionsolar' or 'ree'.
+    - record (dict): The archived record, with its endpoint, params, fetched time and response.
+    - devStationCodes (dict): The stationCode of every devId, from the device inventory and the archived getDevList
+      responses.
+    - aemetTimezones (dict): The timezone of every AEMET station whose observations are saved, by idema.
+
+    Returns:
+    - list: The Points.
+    """
+    endpoint = record['endpoint']
+    params = record['params'] or {}
+    data = record['response']
+
+    if source == 'ree':
+        return ree_points(data)
+    if source == 'ide':
+        return ide_points(data)
+    if source == 'aemet':
+        if endpoint != 'observacion/convencional/todas' or not aemetTimezones:
+            return []
+        return [process_entry(entry, aemetTimezones[entry['idema']]) for entry in data if entry['idema'] in aemetTimezones]
+    if source != 'fusionsolar' or data.get("data") is None:
+        return []
+
+    if endpoint in station_kpi_fields:
+        return station_kpi_points(endpoint, data)
+    if endpoint == 'getStationRealKpi':
+        # The historical script requests it by collectTime and uses the time of the response, the poller the tick
+        if 'collectTime' in params:
+            return station_real_kpi_points(data, data["params"]["currentTime"])
+        return station_real_kpi_points(data, align_time(record['fetched']))
+    if endpoint in dev_kpi_measurements:
+        known = [entry for entry in data["data"] if entry["devId"] in devStationCodes]
+        if len(known) != len(data["data"]):
+            print("Skipping", len(data["data"]) - len(known), endpoint, "entries of unknown devices")
+        if endpoint == 'getDevRealKpi':
+            return dev_kpi_points(endpoint, { "data": known }, devStationCodes, align_time(record['fetched']), params.get("devTypeId"))
+        return dev_kpi_points(endpoint, { "data": known }, devStationCodes)
+    return []
+
+
+def init_worker(worker_config, worker_options):
+    global config, options, writer
+    config = worker_config
+    options = worker_options
+    writer = BatchWriter(connect_influxdb(config), config)
+
+
+def kept(point):
+    # Apply the measurement and time filters to a point
+    return ((options['measurements'] is None or point_measurement(point) in options['measurements'])
+            and (options['start'] is None or point_time(point) >= options['start'])
+            and (options['end'] is None or point_time(point) < options['end']))
+
+
+def keep(points):
+    return [point for point in points if kept(point)]
+
+
+def replay_segment(path):
+    """
+    Replay every record of an archived segment.
+
+    Returns:
+    - int: The number of points written.
+    """
+    source = path.replace('\\', '/').split('/')[-2]
+    endpoints = None
+    if source == 'fusionsolar' and options['measurements'] is not None:
+        # The index tells which records can be skipped without decompressing them
+        endpoints = options['measurements']
+    elif source == 'aemet':
+        endpoints = ['observacion/convencional/todas']
+
+    count = 0
+    for record in read_segment(path, endpoints):
+        points = keep(record_points(source, record, options['devStationCodes'], options['aemetTimezones']))
+        writer.write(points)
+        count += len(points)
+    writer.flush()
+    print("Replayed", count, "points from", path)
+    return count
+
+
+def replay_aemet_csv(path):
+    """
+    Replay a daily AEMET radiation CSV saved by aemet_radiacion_csv.py.
+
+    Returns:
+    - int: The number of points written.
+    """
+    # The points are written a batch at a time as the rows are read
+    count = writer.write_stream(point for point in radiation_points(csv_rows(path), options['aemetStations']) if kept(point))
+    writer.flush()
+    print("Replayed", count, "points from", path)
+    return count
+
+
+def parse_date(date):
+    return datetime.strptime(date, '%Y-%m-%d').replace(tzinfo=timezone.utc) if date else None
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--archive', help='Archive directory (the "archive" dir in local.json by default)')
+    arg_parser.add_argument('--measurement', action='append', help='Only replay this measurement, can be repeated')
+    arg_parser.add_argument('--start', help='Only replay the points from this date (YYYY-MM-DD)')
+    arg_parser.add_argument('--end', help='Only replay the points before this date (YYYY-MM-DD)')
+    arg_parser.add_argument('--aemet', help="Also replay the AEMET radiation CSVs matching this pattern, like 'dailyRadData/radiaciondiaria_*.csv'")
+    arg_parser.add_argument('--workers', type=int, help='Number of worker processes (one per CPU by default)')
+    args = arg_parser.parse_args()
+
+    # Load the configuration from local.json
+    with open('local.json', 'r') as json_file:
+        config = json.load(json_file)
+
+    directory = args.archive or config.get('archive', {}).get('dir', default_archive_dir)
+    measurements = args.measurement
+
+    segments = []
+    for source in ['fusionsolar', 'ree', 'ide']:
+        if measurements is None or source == 'fusionsolar' or source_measurements[source] in measurements:
+            segments += list_segments(directory, source)
+
+    # The device responses don't include the stationCode, we get it from the device inventory and the archived
+    # getDevList responses
+    devStationCodes = {}
+    if measurements is None or set(measurements) & set(dev_kpi_measurements):
+        try:
+            with open(config.get('fusionsolar', {}).get('inventory_file', default_inventory_file), 'r') as json_file:
+                for station in json.load(json_file).values():
+                    for devList in station['devices']:
+                        devStationCodes[devList['id']] = devList['stationCode']
+        except (OSError, ValueError):
+            pass
+        for path in list_segments(directory, 'fusionsolar'):
+            for record in read_segment(path, ['getDevList']):
+                for devList in record['response'].get('data') or []:
+                    devStationCodes[devList['id']] = devList['stationCode']
+
+    # The radiation CSVs only keep the stations that are in the last archived observacion/convencional/todas, and
+    # the observations are only saved for the stations of the CSVs
+    csv_files = []
+    aemetStations = None
+    aemetTimezones = None
+    replay_radiation = measurements is None or 'sun_radiation' in measurements
+    replay_observations = measurements is None or source_measurements['aemet'] in measurements
+    if args.aemet and (replay_radiation or replay_observations):
+        for path in list_segments(directory, 'aemet'):
+            for record in read_segment(path, ['observacion/convencional/todas']):
+                aemetStations = station_index(record['response'])
+        if aemetStations is None:
+            print("There is no archived AEMET station list (observacion/convencional/todas), the AEMET data can't be replayed")
+        else:
+            csv_files = sorted(glob.glob(args.aemet))
+
+        if aemetStations is not None and replay_observations:
+            identifiers = set()
+            for path in csv_files:
+                identifiers |= csv_identifiers(path)
+            # The timezones are looked up here, so the workers don't race to save the new ones
+            timezones = StationTimezones(config)
+            aemetTimezones = { idema: timezones.timezone(station) for idema, station in aemetStations.items()
+                               if idema in identifiers and station['lat'] != 0 and station['lon'] != 0 }
+            timezones.save()
+            segments += list_segments(directory, 'aemet')
+        if not replay_radiation:
+            csv_files = []
+
+    options = { "measurements": measurements, "start": parse_date(args.start), "end": parse_date(args.end),
+                "devStationCodes": devStationCodes, "aemetStations": aemetStations, "aemetTimezones": aemetTimezones }
+
+    with Pool(args.workers, initializer=init_worker, initargs=(config, options)) as pool:
+        results = [pool.apply_async(replay_segment, args=(path,)) for path in segments]
+        results += [pool.apply_async(replay_aemet_csv, args=(path,)) for path in csv_files]
+        total = sum(result.get() for result in results)
+
+    print("Replayed", total, "points from", len(segments), "segments and", len(csv_files), "CSV files")
@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+
+# Retry policy shared by every upstream call (FusionSolar, REE and i-DE): exponential backoff with jitter and a
+# maximum number of attempts, plus a circuit breaker per host. After too many consecutive failures the circuit
+# opens and every call to that host fails straight away until open_time has passed, in this run and in the next
+# cron runs (the state is saved in a file per host). The run ends, and the next one resumes from its watermarks.
+# Every request is sent with the connect and read timeouts of the policy (RetryPolicy.timeout), so a host that
+# accepts the connection and never answers fails like any other error instead of blocking the run forever.
+#
+# Optional settings in local.json:
+#   "retry": { "base_delay": 5, "max_delay": 300, "max_attempts": 6, "failure_threshold": 10, "open_time": 900, "dir": ".circuit",
+#              "timeout": [10, 60] }    Connect and read timeouts in seconds, or a single number for both
+# Without base_delay every script uses its own (10 to 60 seconds for FusionSolar, 20 for REE, 5 for the rest).
+
+import json
+import os
+import random
+import time
+import requests
+from urllib.parse import urlparse
+import metrics
+import profiler
+
+
+class UpstreamError(Exception):
+    """
+    The upstream API didn't answer after every retry.
+    """
+
+
+class CircuitOpenError(UpstreamError):
+    """
+    The circuit of the host is open, it's not called until open_time has passed.
+    """
+
+
+class RetryPolicy:
+    """
+    Retry the requests to a host with exponential backoff, failing fast while its circuit is open.
+
+    Args:
+    - config (dict): The configuration loaded from local.json.
+    - url (str): Any URL of the host.
+    - base_delay (int): Seconds to wait before the first retry if local.json doesn't set base_delay.
+    """
+
+    def __init__(self, config, url, base_delay=5):
+        settings = config.get('retry', {})
+        self.host = urlparse(url).hostname
+        self.base_delay = settings.get('base_delay', base_delay)
+        self.max_delay = settings.get('max_delay', 300)
+        self.max_attempts = settings.get('max_attempts', 6)
+        self.failure_threshold = settings.get('failure_threshold', 10)
+        self.open_time = settings.get('open_time', 900)
+        timeout = settings.get('timeout', [10, 60])
+        # requests wants a tuple for separate connect and read timeouts
+        self.timeout = tuple(timeout) if isinstance(timeout, list) else timeout
+        state_dir = settings.get('dir', '.circuit')
+        os.makedirs(state_dir, exist_ok=True)
+        self.state_file = os.path.join(state_dir, self.host + '.json')
+
+    def load_state(self):
+        try:
+            with open(self.state_file, 'r') as json_file:
+                return json.load(json_file)
+        except (OSError, ValueError):
+            return { "failures": 0, "open_until": 0 }
+
+    def save_state(self, state):
+        tmp_file = self.state_file + '.' + str(os.getpid())
+        with open(tmp_file, 'w') as json_file:
+            json.dump(state, json_file)
+        os.replace(tmp_file, self.state_file)
+
+    def call(self, request, endpoint=''):
+        """
+        Run a request until it gets a 200 answer.
+
+        Args:
+        - request (callable): Sends the request with timeout=self.timeout and returns the requests.Response.
+        - endpoint (str): Name of the endpoint for the metrics, like 'getDevHistoryKpi'.
+
+        Returns:
+        - Response: The first 200 response.
+
+        Raises:
+        - CircuitOpenError: If the circuit of the host is open, or it opens because of this request.
+        - UpstreamError: If every attempt failed.
+        """
+        for attempt in range(self.max_attempts):
+            state = self.load_state()
+            if state['open_until'] > time.time():
+                raise CircuitOpenError(f"{self.host} is failing, not calling it until {time.ctime(state['open_until'])}")
+
+            try:
+                with metrics.timer('tfg_request_duration_seconds', host=self.host, endpoint=endpoint), profiler.phase('fetch'):
+                    response = request()
+                error = None if response.status_code == 200 else f"status code {response.status_code}"
+            except requests.RequestException as e:
+                error = str(e)
+
+            if error is None:
+                if state['failures']:
+                    self.save_state({ "failures": 0, "open_until": 0 })
+                return response
+
+            state['failures'] += 1
+            if state['failures'] >= self.failure_threshold:
+                state['open_until'] = time.time() + self.open_time
+                self.save_state(state)
+                raise CircuitOpenError(f"{self.host} failed {state['failures']} times in a row ({error}), not calling it for {self.open_time} seconds")
+            self.save_state(state)
+            if attempt + 1 == self.max_attempts:
+                break
+
+            # Exponential backoff with jitter, so the runs that failed together don't retry together
+            delay = random.uniform(self.base_delay, min(self.max_delay, self.base_delay * 2 ** attempt))
+            print(f"Request to {self.host} failed ({error}). Retrying in {delay:.0f} seconds...")
+            metrics.inc('tfg_retries_total', host=self.host, endpoint=endpoint)
+            with profiler.phase('sleep'):
+                time.sleep(delay)
+
+        raise UpstreamError(f"{self.host} failed {self.max_attempts} times ({error})")
@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+
+# Local store with the time of the last point written for every series, so the scripts know where to resume
+# without scanning the whole bucket history. It's a SQLite file keyed by bucket, measurement and tags (stationCode,
+# devId, indicator...). InfluxDB is only queried when a series isn't in the store yet.
+#
+# A watermark never moves backwards, so when the data of a series is deleted its watermark has to be cleared too,
+# or the scripts would never fetch it again. delete_data.py does it, and it can be done by hand with:
+#   python3 watermarks.py --measurement ree --tag indicator=1295
+#
+# Optional setting in local.json:
+#   "watermarks_file": "watermarks.sqlite"
+
+from datetime import datetime, timezone
+import argparse
+import json
+import re
+import sqlite3
+import profiler
+
+default_watermarks_file = 'watermarks.sqlite'
+
+
+class WatermarkStore:
+    """
+    Persistent checkpoints of the last time saved per series.
+
+    Args:
+    - config (dict): The configuration loaded from local.json.
+    - client (InfluxDBClient): Used to look up the series that aren't in the store yet.
+    """
+
+    def __init__(self, config, client):
+        self.client = client
+        self.bucket_name = config['influxdb']['bucket']
+        self.db = sqlite3.connect(config.get('watermarks_file', default_watermarks_file))
+        self.db.execute('CREATE TABLE IF NOT EXISTS watermarks ('
+                        ' bucket TEXT NOT NULL,'
+                        ' measurement TEXT NOT NULL,'
+                        ' series TEXT NOT NULL,'
+                        ' time INTEGER NOT NULL,'
+                        ' PRIMARY KEY (bucket, measurement, series))')
+        self.db.commit()
+
+    @staticmethod
+    def series_key(tags):
+        return ','.join(f'{key}={tags[key]}' for key in sorted(tags))
+
+    @profiler.timed('watermark lookup')
+    def get(self, measurement, **tags):
+        """
+        Returns:
+        - datetime: The UTC time of the last point saved for the series, None if it isn't in the store.
+        """
+        row = self.db.execute('SELECT time FROM watermarks WHERE bucket = ? AND measurement = ? AND series = ?',
+                              (self.bucket_name, measurement, self.series_key(tags))).fetchone()
+        if row is None:
+            return None
+        return datetime.fromtimestamp(row[0] / 1000, tz=timezone.utc)
+
+    def set(self, measurement, time, **tags):
+        """
+        Save the time of the last point written for a series. The watermark never moves backwards.
+
+        Args:
+        - measurement (str): The measurement name.
+        - time (datetime or int): The time of the last point, as a datetime or as epoch milliseconds.
+        - tags: The tags that identify the series, like stationCode or devId.
+        """
+        if isinstance(time, datetime):
+            if time.tzinfo is None:
+                time = time.replace(tzinfo=timezone.utc)
+            time = int(time.timestamp() * 1000)
+        self.db.execute('INSERT INTO watermarks (bucket, measurement, series, time) VALUES (?, ?, ?, ?)'
+                        ' ON CONFLICT (bucket, measurement, series) DO UPDATE SET time = MAX(time, excluded.time)',
+                        (self.bucket_name, measurement, self.series_key(tags), int(time)))
+        self.db.commit()
+
+    def clear(self, measurement=None, **tags):
+        """
+        Forget the watermarks of the series of the bucket with these tags, so the scripts fetch them again from their
+        default time (or from the last point left in InfluxDB).
+
+        Args:
+        - measurement (str): Only the series of this measurement, every measurement if None.
+        - tags: Only the series with these tags, they may have more.
+
+        Returns:
+        - int: The number of watermarks cleared.
+        """
+        rows = self.db.execute('SELECT measurement, series FROM watermarks WHERE bucket = ?', (self.bucket_name,)).fetchall()
+        tags = { key: str(value) for key, value in tags.items() }
+        cleared = []
+        for row_measurement, series in rows:
+            if measurement is not None and row_measurement != measurement:
+                continue
+            series_tags = dict(tag.split('=', 1) for tag in series.split(',') if tag)
+            if all(series_tags.get(key) == value for key, value in tags.items()):
+                cleared.append((self.bucket_name, row_measurement, series))
+        self.db.executemany('DELETE FROM watermarks WHERE bucket = ? AND measurement = ? AND series = ?', cleared)
+        self.db.commit()
+        return len(cleared)
+
+    def clear_predicate(self, predicate):
+        """
+        Forget the watermarks of the series deleted with an InfluxDB delete predicate, like
+        '_measurement="ree" AND indicator="1295"'. Only the equality of tags joined with AND is supported.
+
+        Args:
+        - predicate (str): The predicate given to the delete API.
+
+        Returns:
+        - int: The number of watermarks cleared.
+        """
+        tags = {}
+        for condition in re.split(r'\s+AND\s+', predicate.strip(), flags=re.IGNORECASE):
+            match = re.fullmatch(r'\s*(\w+)\s*=\s*"?([^"]*?)"?\s*', condition)
+            if match is None:
+                raise ValueError(f"Unsupported delete predicate: {predicate}")
+            tags[match.group(1)] = match.group(2)
+        measurement = tags.pop('_measurement', None)
+        return self.clear(measurement, **tags)
+
+    @profiler.timed('watermark lookup')
+    def resume(self, measurement, default_time, **tags):
+        """
+        Get the time to resume a series from. If the series isn't in the store, look for its last point in
+        InfluxDB, but only from default_time onwards, and save it in the store.
+
+        Args:
+        - measurement (str): The measurement name.
+        - default_time (datetime): The time to start from if there is no previous data.
+        - tags: The tags that identify the series, like stationCode or devId.
+
+        Returns:
+        - datetime: The time of the last point saved, or default_time if there are none.
+        """
+        time = self.get(measurement, **tags)
+        if time is not None:
+            return time
+
+        if default_time.tzinfo is None:
+            default_time = default_time.replace(tzinfo=timezone.utc)
+        query = (f'from(bucket:"{self.bucket_name}")'
+                 f' |> range(start: {default_time.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")})'
+                 f' |> filter(fn: (r) => r["_measurement"] == "{measurement}")')
+        for key, value in tags.items():
+            query += f' |> filter(fn: (r) => r["{key}"] == "{value}")'
+        # Without sort() the last point of each series is read straight from the storage engine
+        query += ' |> last()'
+        result = self.client.query_api().query(query)
+
+        times = [record.get_time() for table in result for record in table.records]
+        if not times:
+            return default_time
+        time = max(times)
+        self.set(measurement, time, **tags)
+        return time
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Clear the watermarks of some series of the bucket in local.json')
+    arg_parser.add_argument('--measurement', help='Only the series of this measurement')
+    arg_parser.add_argument('--tag', action='append', default=[], help='Only the series with this tag, as key=value, can be repeated')
+    args = arg_parser.parse_args()
+    if args.measurement is None and not args.tag:
+        arg_parser.error('give --measurement or --tag, use both to clear a single series')
+
+    # Load the configuration from local.json
+    with open('local.json', 'r') as json_file:
+        config = json.load(json_file)
+
+    watermarks = WatermarkStore(config, None)
+    cleared = watermarks.clear(args.measurement, **dict(tag.split('=', 1) for tag in args.tag))
+    print(f"Cleared {cleared} watermarks of the bucket {watermarks.bucket_name}")